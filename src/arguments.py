@@ -23,11 +23,30 @@ def process_args(terminal_args, config_options):
         if not processed_args['pkg_man']:
             raise ValueError("'pkg_man' required when 'layer_type' is base")
         processed_args['gpgcheck'] = terminal_args.gpgcheck or config_options.get('gpgcheck', True)
+        processed_args['batch_cmds'] = terminal_args.batch_cmds or config_options.get('batch_cmds', False)
+        processed_args['repo_proxy_cache'] = terminal_args.repo_proxy_cache or config_options.get('repo_proxy_cache', '')
+        processed_args['repo_proxy_max_size'] = terminal_args.repo_proxy_max_size or config_options.get('repo_proxy_max_size', 0)
+        processed_args['lockfile'] = terminal_args.lockfile or config_options.get('lockfile', '')
+        processed_args['locked'] = terminal_args.locked or config_options.get('locked', False)
+        if processed_args['locked'] and not processed_args['lockfile']:
+            raise ValueError("'lockfile' required when 'locked' is set")
+        processed_args['copyfiles_hardlink'] = terminal_args.copyfiles_hardlink or config_options.get('copyfiles_hardlink', False)
+        processed_args['exec_backend'] = terminal_args.exec_backend or config_options.get('exec_backend', 'buildah')
+        if processed_args['exec_backend'] not in ('buildah', 'chroot'):
+            raise ValueError("'exec_backend' must be one of buildah, chroot")
+        processed_args['step_jobs'] = terminal_args.step_jobs or config_options.get('step_jobs', 4)
+        processed_args['pkg_cache'] = terminal_args.pkg_cache or config_options.get('pkg_cache', '')
+        processed_args['pkg_cache_max_size'] = terminal_args.pkg_cache_max_size or config_options.get('pkg_cache_max_size', 0)
+        processed_args['pkg_cache_max_age'] = terminal_args.pkg_cache_max_age or config_options.get('pkg_cache_max_age', 0)
     elif processed_args['layer_type'] == "ansible":
         processed_args['ansible_groups'] = terminal_args.group_list or config_options.get('groups', [])
         processed_args['ansible_pb'] = terminal_args.pb or config_options.get('playbooks', [])
         processed_args['ansible_inv'] = terminal_args.inventory or config_options.get('inventory', [])
         processed_args['ansible_vars'] = terminal_args.inventory or config_options.get('vars', {})
+        processed_args['ansible_connection'] = terminal_args.ansible_connection or config_options.get('ansible_connection', 'buildah')
+        if processed_args['ansible_connection'] not in ('buildah', 'chroot'):
+            raise ValueError("'ansible_connection' must be one of buildah, chroot")
+        processed_args['ansible_fact_cache'] = terminal_args.ansible_fact_cache or config_options.get('ansible_fact_cache', '')
 
         verbosity_values = list(range(0,5))
         if terminal_args.ansible_verbosity in verbosity_values:
@@ -58,6 +77,15 @@ def process_args(terminal_args, config_options):
         }
         processed_args['s3_prefix'] = terminal_args.s3_prefix or config_options.get('s3_prefix', '')
         processed_args['s3_bucket'] = terminal_args.s3_bucket or config_options.get('s3_bucket', 'boot-images')
+        processed_args['s3_part_size'] = terminal_args.s3_part_size or config_options.get('s3_part_size', '64M')
+        processed_args['s3_concurrency'] = terminal_args.s3_concurrency or config_options.get('s3_concurrency', 10)
+        processed_args['s3_stream'] = terminal_args.s3_stream or config_options.get('s3_stream', False)
+        processed_args['s3_chunk_prefix'] = terminal_args.s3_chunk_prefix or config_options.get('s3_chunk_prefix', '')
+        processed_args['squashfs_compressor'] = terminal_args.squashfs_compressor or config_options.get('squashfs_compressor')
+        processed_args['squashfs_level'] = terminal_args.squashfs_level or config_options.get('squashfs_level')
+        processed_args['squashfs_block_size'] = terminal_args.squashfs_block_size or config_options.get('squashfs_block_size')
+        processed_args['squashfs_processors'] = terminal_args.squashfs_processors or config_options.get('squashfs_processors')
+        processed_args['squashfs_exclude'] = terminal_args.squashfs_exclude or config_options.get('squashfs_exclude', [])
 
     processed_args['publish_registry'] = config_options.get('publish_registry', '') or terminal_args.publish_registry
     if processed_args['publish_registry']:
@@ -66,6 +94,12 @@ def process_args(terminal_args, config_options):
 
     processed_args['publish_tags'] = terminal_args.publish_tags or config_options.get('publish_tags',['latest'])
     
+    processed_args['trace_file'] = terminal_args.trace_file or config_options.get('trace_file', '')
+    processed_args['metrics_file'] = terminal_args.metrics_file or config_options.get('metrics_file', '')
+
+    processed_args['build_cache'] = terminal_args.build_cache or config_options.get('build_cache', '')
+    processed_args['size_report'] = terminal_args.size_report or config_options.get('size_report', '')
+
     processed_args['scap_benchmark'] = terminal_args.scap_benchmark or config_options.get('scap_benchmark', False)
     processed_args['oval_eval'] = terminal_args.oval_eval or config_options.get('oval_eval', False)
     processed_args['install_scap'] = terminal_args.install_scap or config_options.get('install_scap', False)
@@ -0,0 +1,161 @@
+"""
+Build Cache Module
+
+This module fingerprints a base layer build from its normalized configuration,
+the contents of its copyfiles sources, the parent image digest and the resolved
+arguments. Finished builds are committed to a local cache image so a later
+build with the same fingerprint can be re-published without running
+`buildah from` again.
+"""
+
+import hashlib
+import json
+import logging
+import os
+# written modules
+from utils import cmd
+
+CACHE_REPO = "localhost/image-build-cache"
+
+# Arguments that change the contents of the image or of the published
+# SquashFS. Only these go into the fingerprint, so arguments added later do not
+# invalidate the cache unless they are added here.
+FINGERPRINT_ARGS = [
+    'gpgcheck',
+    'install_scap',
+    'layer_type',
+    'locked',
+    'oval_eval',
+    'parent',
+    'pkg_man',
+    'proxy',
+    'scap_benchmark',
+    'squashfs_block_size',
+    'squashfs_compressor',
+    'squashfs_exclude',
+    'squashfs_level',
+]
+
+def _hash_path(path, h):
+    """Feed a file, or every file below a directory, into the hash h"""
+    if not os.path.exists(path):
+        # Sources like URLs are handed straight to `buildah copy`, so only
+        # their name can be part of the fingerprint.
+        h.update(path.encode())
+        return
+
+    if os.path.isfile(path):
+        files = [path]
+    else:
+        files = []
+        for root, dirs, fnames in os.walk(path):
+            dirs.sort()
+            for f in sorted(fnames):
+                files.append(os.path.join(root, f))
+
+    for f in files:
+        h.update(os.path.relpath(f, path).encode())
+        h.update(oct(os.lstat(f).st_mode).encode())
+        if os.path.islink(f):
+            h.update(os.readlink(f).encode())
+            continue
+        with open(f, 'rb') as fd:
+            for chunk in iter(lambda: fd.read(1024 * 1024), b''):
+                h.update(chunk)
+
+def parent_digest(parent, registry_opts_pull):
+    """
+    Returns the image ID of the parent image. The parent gets pulled to find
+    it, which is much cheaper than creating a working container from it.
+    """
+    if parent == "scratch":
+        return "scratch"
+
+    def buildah_handler(line):
+        out.append(line)
+    out = []
+    cmd(["buildah", "pull", "--quiet"] + registry_opts_pull + [parent], stdout_handler = buildah_handler)
+    return out[-1]
+
+def fingerprint(image_config, args):
+    """
+    Computes the fingerprint of a base layer build
+
+    Returns:
+        str: hex encoded sha256 fingerprint
+    """
+    h = hashlib.sha256()
+
+    h.update(json.dumps(image_config.config_data, sort_keys=True, default=str).encode())
+
+    for f in image_config.get_copy_files():
+        _hash_path(f['src'], h)
+
+    h.update(parent_digest(args['parent'], args['registry_opts_pull']).encode())
+
+    # A locked build installs whatever the lockfile lists
+    if args.get('locked'):
+        _hash_path(args['lockfile'], h)
+
+    resolved = {k: args.get(k) for k in FINGERPRINT_ARGS}
+    h.update(json.dumps(resolved, sort_keys=True, default=str).encode())
+
+    return h.hexdigest()
+
+class BuildCache:
+    def __init__(self, cache_dir):
+        self.cache_dir = os.path.expanduser(cache_dir)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.logger = logging.getLogger(__name__)
+
+    def image_ref(self, name, fp):
+        return f"{CACHE_REPO}/{name}:{fp}"
+
+    def _entry_path(self, fp):
+        return os.path.join(self.cache_dir, fp + ".json")
+
+    def _image_exists(self, image):
+        rc = cmd(["buildah", "inspect", "--type", "image", image],
+                 stdout_handler=logging.debug, stderr_handler=logging.debug, check=False)
+        return rc == 0
+
+    def lookup(self, fp, args):
+        """
+        Returns the cache entry for fingerprint fp if it exists and can satisfy
+        every publish target in args, otherwise None.
+        """
+        if not os.path.exists(self._entry_path(fp)):
+            self.logger.info(f"BUILD CACHE: miss for {fp}")
+            return None
+
+        with open(self._entry_path(fp), 'r') as f:
+            entry = json.load(f)
+
+        if not self._image_exists(entry['image']):
+            self.logger.info(f"BUILD CACHE: cached image {entry['image']} no longer exists")
+            return None
+
+        # The squashfs is only ever stored in S3, so a cached build can only be
+        # re-published there if it was pushed to the same endpoint and bucket
+        # before. A manifest is only copied, so its chunks must already be
+        # under the same chunk prefix.
+        if args['publish_s3']:
+            s3 = entry.get('s3')
+            if (not s3 or s3['endpoint_url'] != args['credentials']['endpoint_url']
+                    or s3['bucket'] != args['s3_bucket']
+                    or s3.get('chunk_prefix') != args['s3_chunk_prefix']):
+                self.logger.info(f"BUILD CACHE: {fp} was never published to {args['publish_s3']} "
+                                 f"bucket {args['s3_bucket']} with chunk prefix '{args['s3_chunk_prefix']}'")
+                return None
+
+        self.logger.info(f"BUILD CACHE: hit for {fp} ({entry['image']})")
+        return entry
+
+    def store(self, fp, name, published):
+        """Records the result of a finished build under fingerprint fp"""
+        entry = {'fingerprint': fp, 'image': self.image_ref(name, fp)}
+        entry.update(published)
+        with open(self._entry_path(fp) + ".tmp", 'w') as f:
+            json.dump(entry, f, indent=2)
+        os.replace(self._entry_path(fp) + ".tmp", self._entry_path(fp))
+        self.logger.info(f"BUILD CACHE: stored {fp} as {entry['image']}")
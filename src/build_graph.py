@@ -0,0 +1,133 @@
+"""
+Build Graph Module
+
+This module builds a dependency graph from several image-build config files,
+linking each config to the config that publishes its parent, and runs the
+builds concurrently with each build starting as soon as its parent has been
+published.
+"""
+
+import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+# written modules
+from image_config import ImageConfig
+from utils import cmd
+
+IMAGE_BUILD = os.path.join(os.path.dirname(os.path.abspath(__file__)), "image-build")
+
+class BuildNode:
+    def __init__(self, config):
+        self.config = config
+        image_config = ImageConfig(config)
+        options = image_config.get_options()
+        self.name = options.get('name', 'base')
+        self.parent = options.get('parent', 'scratch')
+        # An ansible layer can build several images, each with its own parent
+        images = [(self.name, options.get('publish_tags', ['latest']))]
+        self.parents = {self.parent}
+        if options.get('layer_type') == "ansible" and image_config.get_targets():
+            images = [(t['name'], t.get('publish_tags', options.get('publish_tags', ['latest'])))
+                      for t in image_config.get_targets()]
+            self.parents = {t.get('parent', self.parent) for t in image_config.get_targets()}
+
+        # Every reference a child config could use as its parent
+        self.refs = set()
+        for name, tags in images:
+            if type(tags) is not list:
+                tags = [tags]
+            for tag in tags:
+                self.refs.add(name + ':' + tag)
+                self.refs.add('localhost/' + name + ':' + tag)
+                if options.get('publish_registry'):
+                    self.refs.add(options['publish_registry'].rstrip('/') + '/' + name + ':' + tag)
+
+        self.deps = []
+        self.children = []
+
+class BuildGraph:
+    def __init__(self, configs):
+        self.logger = logging.getLogger(__name__)
+        self.nodes = [BuildNode(c) for c in configs]
+
+        for node in self.nodes:
+            for other in self.nodes:
+                if other is not node and node.parents & other.refs:
+                    node.deps.append(other)
+                    other.children.append(node)
+            if node.deps:
+                self.logger.info(f"{node.config}: waiting on {', '.join(d.config for d in node.deps)}")
+
+        self._check_cycles()
+
+    def _check_cycles(self):
+        state = {}
+        def visit(node, path):
+            if state.get(node) == "done":
+                return
+            if state.get(node) == "visiting":
+                raise ValueError("dependency cycle between configs: " + " -> ".join(n.config for n in path + [node]))
+            state[node] = "visiting"
+            for d in node.deps:
+                visit(d, path + [node])
+            state[node] = "done"
+        for node in self.nodes:
+            visit(node, [])
+
+    def _build(self, node, extra_args):
+        prefix = f"[{node.name}] "
+        args = [sys.executable, IMAGE_BUILD, '--config', node.config] + extra_args
+        self.logger.info(prefix + "starting build")
+        rc = cmd(args,
+                 stdout_handler=lambda line: print(prefix + line, flush=True),
+                 stderr_handler=lambda line: print(prefix + line, file=sys.stderr, flush=True),
+                 check=False)
+        return rc
+
+    def run(self, jobs, extra_args=[]):
+        """
+        Builds every config, running at most jobs builds at once
+
+        Returns:
+            dict: config file -> 'built', 'failed' or 'skipped'
+        """
+        results = {}
+        waiting = {node: len(node.deps) for node in self.nodes}
+        ready = [node for node in self.nodes if not node.deps]
+        running = {}
+
+        def skip(node):
+            for child in node.children:
+                if child.config not in results:
+                    results[child.config] = "skipped"
+                    self.logger.error(f"{child.config}: skipped, parent {node.config} was not built")
+                    skip(child)
+
+        with ThreadPoolExecutor(jobs) as pool:
+            while ready or running:
+                while ready and len(running) < jobs:
+                    node = ready.pop(0)
+                    running[pool.submit(self._build, node, extra_args)] = node
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    node = running.pop(future)
+                    try:
+                        rc = future.result()
+                    except Exception as e:
+                        self.logger.error(f"{node.config}: {e}")
+                        rc = 1
+
+                    if rc == 0:
+                        results[node.config] = "built"
+                        for child in node.children:
+                            waiting[child] -= 1
+                            if waiting[child] == 0 and child.config not in results:
+                                ready.append(child)
+                    else:
+                        results[node.config] = "failed"
+                        self.logger.error(f"{node.config}: build failed with exit code {rc}")
+                        skip(node)
+
+        return results
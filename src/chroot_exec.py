@@ -0,0 +1,122 @@
+"""
+Chroot Execution Module
+
+This module provides a class, ChrootSession, that runs commands in the mounted
+rootfs of a scratch build with chroot instead of `buildah run`. The mounts the
+commands need (/proc, /sys, /dev and the host's resolv.conf) are set up once
+for the whole build and removed afterwards, so every command only costs a
+chroot and a shell, not new namespaces and runtime state.
+
+Like with `buildah run`, commands cannot change the host through these mounts:
+/dev is a fresh tmpfs with only the basic device nodes and its own devpts
+instance, and resolv.conf is a copy of the host's.
+"""
+
+import logging
+import os
+import shutil
+import stat
+import tempfile
+# written modules
+from utils import cmd
+from tracing import traced
+
+# The environment `buildah run` gives commands by default
+DEFAULT_PATH = "/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin"
+# Host variables passed on to commands, like `buildah run` does
+PASSTHROUGH_ENV = ['http_proxy', 'https_proxy', 'ftp_proxy', 'no_proxy',
+                   'HTTP_PROXY', 'HTTPS_PROXY', 'FTP_PROXY', 'NO_PROXY', 'TERM']
+# The device nodes in /dev, as (name, major, minor)
+DEVICES = [('null', 1, 3), ('zero', 1, 5), ('full', 1, 7), ('random', 1, 8),
+           ('urandom', 1, 9), ('tty', 5, 0)]
+DEV_LINKS = [('ptmx', 'pts/ptmx'), ('fd', '/proc/self/fd'), ('stdin', '/proc/self/fd/0'),
+             ('stdout', '/proc/self/fd/1'), ('stderr', '/proc/self/fd/2')]
+
+class ChrootSession:
+    def __init__(self, root):
+        self.root = root
+        self.mounts = []
+        self.created = []
+        self.resolv_copy = None
+        self.logger = logging.getLogger(__name__)
+        self.env = {'PATH': DEFAULT_PATH, 'HOME': '/root', 'HOSTNAME': 'localhost', 'container': 'chroot'}
+        for k in PASSTHROUGH_ENV:
+            if k in os.environ:
+                self.env[k] = os.environ[k]
+
+    @property
+    def active(self):
+        """Whether the rootfs is set up for running commands"""
+        return bool(self.mounts)
+
+    def _path(self, path):
+        return os.path.join(self.root, path.lstrip('/'))
+
+    def _mount(self, args, target):
+        cmd(["mount"] + args + [target])
+        self.mounts.append(target)
+
+    @traced('chroot.setup')
+    def setup(self):
+        """Mounts /proc, /sys, /dev and a copy of resolv.conf into the rootfs"""
+        if os.geteuid() != 0:
+            raise PermissionError("the chroot execution backend has to run as root")
+        self.logger.info(f"CHROOT: setting up {self.root}")
+        try:
+            for d in ('proc', 'sys', 'dev'):
+                os.makedirs(self._path(d), mode=0o755, exist_ok=True)
+            self._mount(["-t", "proc", "proc"], self._path("proc"))
+            self._mount(["-t", "sysfs", "-o", "ro", "sysfs"], self._path("sys"))
+            self._setup_dev()
+
+            # Name resolution, unless the image links resolv.conf elsewhere
+            resolv = self._path("etc/resolv.conf")
+            if os.path.exists("/etc/resolv.conf") and not os.path.islink(resolv):
+                if not os.path.exists(resolv):
+                    os.makedirs(os.path.dirname(resolv), exist_ok=True)
+                    open(resolv, 'a').close()
+                    self.created.append(resolv)
+                # A copy, so that commands writing resolv.conf do not change the host's
+                fd, self.resolv_copy = tempfile.mkstemp(prefix="image-build-resolv-")
+                os.close(fd)
+                shutil.copyfile("/etc/resolv.conf", self.resolv_copy)
+                os.chmod(self.resolv_copy, 0o644)
+                self._mount(["--bind", self.resolv_copy], resolv)
+        except BaseException:
+            self.teardown()
+            raise
+
+    def _setup_dev(self):
+        """Mounts a tmpfs with the basic device nodes and a private devpts on /dev"""
+        dev = self._path("dev")
+        self._mount(["-t", "tmpfs", "-o", "mode=755,nosuid,size=64k", "tmpfs"], dev)
+        for name, major, minor in DEVICES:
+            path = os.path.join(dev, name)
+            os.mknod(path, 0o666 | stat.S_IFCHR, os.makedev(major, minor))
+            os.chmod(path, 0o666)
+        for name, target in DEV_LINKS:
+            os.symlink(target, os.path.join(dev, name))
+        os.mkdir(os.path.join(dev, "pts"), 0o755)
+        self._mount(["-t", "devpts", "-o", "newinstance,ptmxmode=0666,mode=620,gid=5", "devpts"],
+                    os.path.join(dev, "pts"))
+        os.mkdir(os.path.join(dev, "shm"), 0o1777)
+        os.chmod(os.path.join(dev, "shm"), 0o1777)
+
+    @traced('chroot.teardown')
+    def teardown(self):
+        """Removes everything setup() added to the rootfs"""
+        while self.mounts:
+            target = self.mounts.pop()
+            rc = cmd(["umount", target], check=False)
+            if rc != 0:
+                self.logger.warn(f"CHROOT: {target} is busy, detaching it")
+                cmd(["umount", "--lazy", target], check=False)
+        while self.created:
+            os.unlink(self.created.pop())
+        if self.resolv_copy:
+            os.unlink(self.resolv_copy)
+            self.resolv_copy = None
+
+    def command(self, args):
+        """Returns the command line that runs args in the rootfs"""
+        return ["chroot", self.root] + args
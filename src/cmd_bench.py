@@ -0,0 +1,73 @@
+"""
+Command Engine Benchmark Module
+
+This module compares the per-call overhead and the line throughput of
+utils.cmd with the thread-per-stream implementation it replaced.
+"""
+
+import logging
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from subprocess import PIPE, Popen
+# written modules
+from utils import engine
+
+#####
+# The previous utils.cmd implementation, kept as the baseline.
+# Shamelessly stolen from https://stackoverflow.com/questions/18421757/live-output-from-subprocess-command/76634163#76634163
+# User: ddelange
+def threaded_run(args, stdout_handler, stderr_handler):
+    with Popen(args, text=True, stdout=PIPE, stderr=PIPE) as process:
+        with ThreadPoolExecutor(2) as pool:  # two threads to handle the streams
+            exhaust = partial(pool.submit, partial(deque, maxlen=0))
+            exhaust(stdout_handler(line[:-1]) for line in process.stdout)
+            exhaust(stderr_handler(line[:-1]) for line in process.stderr)
+    return process.poll()
+
+def selector_run(args, stdout_handler, stderr_handler):
+    return engine.run(args, stdout_handler, stderr_handler)
+
+IMPLEMENTATIONS = {
+    'threaded': threaded_run,
+    'selector': selector_run,
+}
+
+def _null(line):
+    pass
+
+def bench_calls(run, calls):
+    """Returns the mean wall time of running `true`"""
+    start = time.perf_counter()
+    for _ in range(calls):
+        run(["true"], _null, _null)
+    return (time.perf_counter() - start) / calls
+
+def bench_lines(run, lines, handler):
+    """Returns the lines per second handled for a command printing lines lines"""
+    args = [sys.executable, "-c", f"import sys; sys.stdout.writelines('line %d of the output\\n' % i for i in range({lines}))"]
+    start = time.perf_counter()
+    run(args, handler, _null)
+    return lines / (time.perf_counter() - start)
+
+def run_benchmark(calls, lines):
+    # A disabled logging call is what most output lines go through during a build
+    logging.getLogger().setLevel(logging.WARN)
+    results = []
+    for name, run in IMPLEMENTATIONS.items():
+        results.append({
+            'implementation': name,
+            'call_overhead': bench_calls(run, calls),
+            'lines_per_second': bench_lines(run, lines, _null),
+            'logged_lines_per_second': bench_lines(run, lines, logging.debug),
+        })
+    return results
+
+def print_results(results):
+    print("CMD BENCHMARK".center(70, '-'))
+    print(f"{'implementation':<15} {'us/call':>10} {'lines/s':>14} {'logged lines/s':>16}")
+    for r in results:
+        print(f"{r['implementation']:<15} {r['call_overhead'] * 1e6:>10.0f} "
+              f"{r['lines_per_second']:>14,.0f} {r['logged_lines_per_second']:>16,.0f}")
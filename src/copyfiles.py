@@ -0,0 +1,226 @@
+"""
+Copyfiles Module
+
+This module provides a class, RootfsCopier, that copies copyfiles sources
+straight into a mounted container rootfs with the same results as
+`buildah copy`: a file goes to dest (or into dest, if that is a directory), a
+directory's contents go into dest, and ownership defaults to root unless
+--chown is given. Files are reflinked when the filesystem supports it, and can
+be hardlinked when that is allowed and the source already has the right
+ownership and mode.
+"""
+
+import errno
+import fcntl
+import logging
+import os
+import shutil
+import stat
+
+# From linux/fs.h
+FICLONE = 0x40049409
+# `buildah copy` options that RootfsCopier handles itself
+DIRECT_OPTS = {'--chown', '--chmod', '--quiet', '-q'}
+MAX_SYMLINKS = 40
+
+class UnsupportedCopy(Exception):
+    """Raised for sources that have to be copied with `buildah copy` instead"""
+
+def parse_opts(opts):
+    """
+    Turns the opts of a copyfiles entry into a dict of `buildah copy` options
+
+    Returns:
+        dict: option name to value (True for flags)
+    """
+    args = []
+    for o in opts:
+        args.extend(o.split())
+    parsed = {}
+    i = 0
+    while i < len(args):
+        name, eq, value = args[i].partition('=')
+        if not eq and name in ('--chown', '--chmod', '--from', '--contextdir', '--ignorefile',
+                               '--timestamp', '--add-history', '--cert-dir', '--creds', '--decryption-key',
+                               '--retry', '--retry-delay') and i + 1 < len(args):
+            i += 1
+            value = args[i]
+        parsed[name] = value if (eq or value) else True
+        i += 1
+    return parsed
+
+class RootfsCopier:
+    def __init__(self, root, hardlink=False):
+        self.root = os.path.realpath(root)
+        self.hardlink = hardlink
+        self.stats = {'reflinked': 0, 'hardlinked': 0, 'copied': 0, 'bytes': 0}
+        self._users = None
+        self._groups = None
+
+    def supports(self, src, opts):
+        """Whether src can be copied directly with the options opts"""
+        if not set(opts) <= DIRECT_OPTS:
+            return False
+        # URLs, globs and anything else `buildah copy` resolves itself
+        return os.path.lexists(src)
+
+    def resolve(self, path):
+        """
+        Returns the host path of path inside the rootfs, following symlinks
+        inside the rootfs, so that absolute links cannot point outside of it
+        """
+        parts = [p for p in path.split('/') if p not in ('', '.')]
+        resolved = self.root
+        links = 0
+        while parts:
+            part = parts.pop(0)
+            if part == '..':
+                if resolved != self.root:
+                    resolved = os.path.dirname(resolved)
+                continue
+            candidate = os.path.join(resolved, part)
+            if os.path.islink(candidate):
+                links += 1
+                if links > MAX_SYMLINKS:
+                    raise OSError(errno.ELOOP, "too many levels of symbolic links", path)
+                target = os.readlink(candidate)
+                if target.startswith('/'):
+                    resolved = self.root
+                parts = [p for p in target.split('/') if p not in ('', '.')] + parts
+                continue
+            resolved = candidate
+        return resolved
+
+    def _read_db(self, name):
+        entries = {}
+        try:
+            with open(self.resolve('/etc/' + name), 'r') as f:
+                for line in f:
+                    fields = line.rstrip('\n').split(':')
+                    if len(fields) >= 4 and not line.startswith('#'):
+                        entries[fields[0]] = fields
+        except FileNotFoundError:
+            pass
+        return entries
+
+    def owner(self, chown):
+        """Returns the uid and gid for a --chown value, looked up in the rootfs"""
+        if not chown:
+            return 0, 0
+        user, _, group = chown.partition(':')
+        if self._users is None:
+            self._users = self._read_db('passwd')
+            self._groups = self._read_db('group')
+        if user.isdigit():
+            uid = int(user)
+            gid = uid
+        elif user in self._users:
+            uid = int(self._users[user][2])
+            gid = int(self._users[user][3])
+        else:
+            raise ValueError(f"no user {user} in the image")
+        if group:
+            if group.isdigit():
+                gid = int(group)
+            elif group in self._groups:
+                gid = int(self._groups[group][2])
+            else:
+                raise ValueError(f"no group {group} in the image")
+        return uid, gid
+
+    def _makedirs(self, path):
+        """Creates the missing parents of path like `buildah copy` does (root owned, 0755)"""
+        missing = []
+        while not os.path.lexists(path) and path != self.root:
+            missing.append(path)
+            path = os.path.dirname(path)
+        for d in reversed(missing):
+            os.mkdir(d, 0o755)
+            os.chmod(d, 0o755)
+
+    def _replace(self, dest):
+        """Removes whatever is at dest, without following a symlink at dest"""
+        if os.path.lexists(dest) and not (os.path.isdir(dest) and not os.path.islink(dest)):
+            os.unlink(dest)
+
+    def _copy_file(self, src, dest, uid, gid, mode):
+        st = os.stat(src)
+        self._replace(dest)
+        if (self.hardlink and st.st_uid == uid and st.st_gid == gid
+                and (mode is None or stat.S_IMODE(st.st_mode) == mode)):
+            try:
+                os.link(src, dest)
+                self.stats['hardlinked'] += 1
+                return
+            except OSError:
+                pass
+
+        with open(src, 'rb') as fsrc, open(dest, 'wb') as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                self.stats['reflinked'] += 1
+            except OSError:
+                shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+                self.stats['copied'] += 1
+        self.stats['bytes'] += st.st_size
+        shutil.copystat(src, dest)
+        os.chown(dest, uid, gid)
+        if mode is not None:
+            os.chmod(dest, mode)
+
+    def _copy_entry(self, src, dest, uid, gid, mode):
+        st = os.lstat(src)
+        if stat.S_ISLNK(st.st_mode):
+            self._replace(dest)
+            os.symlink(os.readlink(src), dest)
+            os.lchown(dest, uid, gid)
+        elif stat.S_ISDIR(st.st_mode):
+            if os.path.islink(dest):
+                # Merge into the directory the link points to, resolved inside
+                # the rootfs rather than on the host
+                resolved = self.resolve(os.path.relpath(dest, self.root))
+                if os.path.isdir(resolved):
+                    dest = resolved
+            if os.path.lexists(dest) and not os.path.isdir(dest):
+                os.unlink(dest)
+            if not os.path.isdir(dest):
+                os.mkdir(dest)
+            for name in sorted(os.listdir(src)):
+                self._copy_entry(os.path.join(src, name), os.path.join(dest, name), uid, gid, mode)
+            shutil.copystat(src, dest)
+            os.chown(dest, uid, gid)
+            if mode is not None:
+                os.chmod(dest, mode)
+        elif stat.S_ISREG(st.st_mode):
+            self._copy_file(src, dest, uid, gid, mode)
+        else:
+            raise UnsupportedCopy(f"{src} is not a regular file, directory or symlink")
+
+    def copy(self, src, dest, opts):
+        """Copies src to dest in the rootfs, like `buildah copy [opts] src dest`"""
+        uid, gid = self.owner(opts.get('--chown'))
+        mode = int(opts['--chmod'], 8) if opts.get('--chmod') else None
+        # Like `buildah copy`, a symlink given as source is followed
+        src = os.path.realpath(src)
+        target = self.resolve(dest)
+        if os.path.isdir(src):
+            self._makedirs(os.path.dirname(target))
+            if not os.path.isdir(target):
+                if os.path.lexists(target):
+                    os.unlink(target)
+                os.mkdir(target, 0o755)
+                os.chmod(target, 0o755)
+            for name in sorted(os.listdir(src)):
+                self._copy_entry(os.path.join(src, name), os.path.join(target, name), uid, gid, mode)
+        else:
+            if dest.endswith('/') or os.path.isdir(target):
+                self._makedirs(target)
+                target = os.path.join(target, os.path.basename(src))
+            else:
+                self._makedirs(os.path.dirname(target))
+            self._copy_entry(src, target, uid, gid, mode)
+
+def batchable(src, dest):
+    """Whether src can share one `buildah copy` with other sources for dest"""
+    # Several sources can only go into a directory
+    return dest.endswith('/') or (os.path.isdir(src) and not any(c in src for c in '*?['))
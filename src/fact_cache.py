@@ -0,0 +1,44 @@
+"""
+Fact Cache Module
+
+This module provides a class, FactCache, that keeps the Ansible facts gathered
+for containers on disk, keyed by the digest of the image a container was
+created from. Containers created from the same image later on get those facts
+instead of gathering them again.
+"""
+
+import json
+import logging
+import os
+import re
+import tempfile
+
+class FactCache:
+    def __init__(self, cache_dir):
+        self.cache_dir = os.path.expanduser(cache_dir)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.logger = logging.getLogger(__name__)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, re.sub(r'[^A-Za-z0-9_.-]', '-', key) + ".json")
+
+    def load(self, key):
+        """Returns the cached facts for key, or None"""
+        try:
+            with open(self._path(key), 'r') as f:
+                facts = json.load(f)
+        except (OSError, ValueError):
+            return None
+        self.logger.info(f"FACT CACHE: using the facts cached for {key}")
+        return facts
+
+    def store(self, key, facts):
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(facts, f, default=str)
+            os.replace(tmp, self._path(key))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        self.logger.info(f"FACT CACHE: stored the facts for {key}")
@@ -46,6 +46,12 @@ class ImageConfig:
     def get_oscap_options(self):
         return self.config_data.get('openscap', [])
 
+    def get_targets(self):
+        return self.config_data.get('targets', [])
+
+    def get_slim_options(self):
+        return self.config_data.get('slim', {})
+
 
 if __name__ == "__main__":
     config = ImageConfig("ochami-images/base-configs/base.yaml")
@@ -3,15 +3,31 @@ import logging
 import os
 import pathmod
 import tempfile
+import shutil
+import time
+import uuid
 # Written Modules
 from utils import cmd
+from repo_files import write_repo_files, gpg_keys
+from lockfile import RPM_QUERYFORMAT
+from copyfiles import RootfsCopier, UnsupportedCopy, parse_opts, batchable
+from tracing import traced
 
 class Installer:
-    def __init__(self, pkg_man, cname, mname, gpgcheck=True):
+    def __init__(self, pkg_man, cname, mname, gpgcheck=True, pkg_cache=None, repo_proxy="", chroot=None, nodocs=False):
         self.pkg_man = pkg_man
         self.cname = cname
         self.mname = mname
         self.gpgcheck = gpgcheck
+        self.pkg_cache = pkg_cache
+        # URL of the local caching repo proxy, only used while installing
+        self.repo_proxy = repo_proxy
+        # ChrootSession to run commands in the mounted rootfs with
+        self.chroot = chroot
+        # Do not install documentation, the image is slimmed anyway
+        self.nodocs = nodocs
+        if nodocs and pkg_man != "dnf":
+            logging.warn(f"Installer: {pkg_man} cannot leave out documentation, it is only removed by slimming")
 
         # Create temporary directory for logs, cache, etc. for package manager
         os.makedirs(os.path.join(mname, "tmp"), exist_ok=True)
@@ -22,6 +38,118 @@ class Installer:
             # DNF complains if the log directory is not present
             os.makedirs(os.path.join(self.tdir, "dnf/log"))
 
+        # Use the persistent package cache if one was given
+        if self.pkg_cache:
+            self.cachedir = self.pkg_cache.path
+            logging.info(f'Installer: Using persistent package cache at {self.cachedir}')
+        elif pkg_man == "dnf":
+            self.cachedir = os.path.join(self.tdir, self.pkg_man, "cache")
+        else:
+            self.cachedir = self.tdir
+
+    def cleanup(self):
+        """Removes the temporary directory and evicts from the package cache"""
+        shutil.rmtree(self.tdir, ignore_errors=True)
+        if self.pkg_cache:
+            self.pkg_cache.report()
+            self.pkg_cache.evict()
+
+    def _run_pkg_man(self, args, **kwargs):
+        """Runs the package manager, holding the package cache while it runs"""
+        if self.repo_proxy:
+            kwargs.setdefault('env', self._proxy_env())
+        if self.pkg_cache is None:
+            return cmd(args, **kwargs)
+        # zypper does not lock its cache directory, so only one build may use it at a time
+        with self.pkg_cache.use(exclusive=(self.pkg_man == "zypper")):
+            return cmd(args, **kwargs)
+
+    def _cache_args(self):
+        """Returns the package manager arguments that keep downloaded packages in the cache"""
+        if self.pkg_cache is None:
+            return []
+        if self.pkg_man == "dnf":
+            return ["--setopt=keepcache=1"]
+        return []
+
+    def _proxy_env(self):
+        """Returns the environment for host commands that download through the repo proxy"""
+        env = os.environ.copy()
+        env['http_proxy'] = env['https_proxy'] = self.repo_proxy
+        return env
+
+    def _proxy_args(self):
+        """Returns the package manager arguments that make it download through the repo proxy"""
+        if self.repo_proxy and self.pkg_man == "dnf":
+            # Overrides the proxy of every repo, without changing the repo files
+            return ["--setopt=*.proxy=" + self.repo_proxy]
+        return []
+
+    def _run_args(self):
+        """Returns the 'buildah run' arguments for running the package manager in the container"""
+        args = self._cache_volume()
+        if self.repo_proxy:
+            # The repo proxy listens on the host's loopback interface
+            args += ['--network', 'host', '--env', 'http_proxy=' + self.repo_proxy,
+                     '--env', 'https_proxy=' + self.repo_proxy]
+        return args
+
+    def _nodocs_args(self):
+        if self.nodocs and self.pkg_man == "dnf":
+            return ["--setopt=tsflags=nodocs"]
+        return []
+
+    def _locked_args(self):
+        """
+        Returns the package manager arguments for installing an exact package
+        set from a lockfile: nothing beyond the given packages, and an error
+        instead of a substitute when one of them is not available
+        """
+        if self.pkg_man == "dnf":
+            return ["--setopt=install_weak_deps=False", "--setopt=strict=True", "--best"]
+        elif self.pkg_man == "zypper":
+            return ["--oldpackage", "--no-recommends"]
+        return []
+
+    @traced('installer.installed_packages')
+    def installed_packages(self):
+        """
+        Returns the installed packages as name-epoch:version-release.arch
+
+        Returns:
+            list: installed packages
+        """
+        out = []
+        def rpm_handler(line):
+            if line and not line.startswith("gpg-pubkey-"):
+                out.append(line)
+        if self.mname:
+            cmd(["rpm", "--root=" + self.mname, "-qa", "--qf", RPM_QUERYFORMAT], stdout_handler=rpm_handler)
+        else:
+            cmd(["buildah","run", self.cname, '--', 'rpm', '-qa', '--qf', RPM_QUERYFORMAT], stdout_handler=rpm_handler)
+        return out
+
+    def _exec(self, args, extra_args=None):
+        """
+        Returns the command line and cmd() arguments for running args in the
+        container: with chroot if a chroot session is used, or with `buildah
+        run` (which commands with buildah_extra_args always need)
+        """
+        if self.chroot and self.chroot.active and not extra_args:
+            return self.chroot.command(args), {'env': self.chroot.env}
+        return ["buildah","run"] + (extra_args or []) + [self.cname, '--'] + args, {}
+
+    def _cache_volume(self):
+        """Returns the 'buildah run' arguments that mount the package cache into the container"""
+        if self.pkg_cache is None:
+            return []
+        if self.pkg_man == "dnf":
+            return ['--volume', self.cachedir + ':/var/cache/dnf']
+        elif self.pkg_man == "zypper":
+            return ['--volume', self.cachedir + ':/var/cache/zypp']
+        return []
+
+    @traced('installer.install_scratch_repos')
     def install_scratch_repos(self, repos, repo_dest, proxy):
         # check if there are repos passed for install
         if len(repos) == 0:
@@ -29,71 +157,40 @@ class Installer:
             return
 
         logging.info(f"REPOS: Installing these repos to {self.cname}")
-        for r in repos:
-            args = []
-            logging.info(r['alias'] + ': ' + r['url'])
-            if self.pkg_man == "zypper":
-                args.append("-D")
-                args.append(os.path.join(self.mname, pathmod.sep_strip(repo_dest)))
-                args.append("addrepo")
-                args.append("-f")
-                args.append("-p")
-                if 'priority' in r:
-                    args.append(r['priority'])
-                else:
-                    args.append('99')
-                args.append(r['url'])
-                args.append(r['alias'])
-            elif self.pkg_man == "dnf":
-                args.append("--setopt=reposdir="+os.path.join(self.mname, pathmod.sep_strip(repo_dest)))
-                args.append("--setopt=logdir="+os.path.join(self.tdir, self.pkg_man, "log"))
-                args.append("--setopt=cachedir="+os.path.join(self.tdir, self.pkg_man, "cache"))
-                if proxy != "":
-                    args.append("--setopt=proxy="+proxy)
-                args.append("config-manager")
-                args.append("--save")
-                args.append("--add-repo")
-                args.append(r['url'])
+        if self.repo_proxy and self.pkg_man == "zypper":
+            # zypper cannot override the proxy of a repo, and the repo proxy forwards to it anyway
+            proxy = ""
+        # Write the repo files straight into the mounted container
+        try:
+            write_repo_files(repos, os.path.join(self.mname, pathmod.sep_strip(repo_dest)),
+                             self.pkg_man, proxy, keep_packages=self.pkg_cache is not None)
+        except Exception as e:
+            raise Exception("Failed to install repos", e)
 
-            rc = cmd([self.pkg_man] + args)
-            if rc != 0:
-                raise Exception("Failed to install repo", r['alias'], r['url'])
-
-            if proxy != "":
-                if r['url'].endswith('.repo'):
-                    repo_name = r['url'].split('/')[-1].split('.repo')[0] + "*"
-                elif r['url'].startswith('https'):
-                    repo_name = r['url'].split('https://')[1].replace('/','_')
-                elif r['url'].startswith('http'):
-                    repo_name = r['url'].split('http://')[1].replace('/','_')
-                args = []
-                args.append('config-manager')
-                args.append('--save')
-                args.append("--setopt=reposdir="+os.path.join(self.mname, pathmod.sep_strip(repo_dest)))
-                args.append("--setopt=logdir="+os.path.join(self.tdir, self.pkg_man, "log"))
-                args.append("--setopt=cachedir="+os.path.join(self.tdir, self.pkg_man, "cache"))
-                args.append('--setopt=*.proxy='+proxy)
-                args.append(repo_name)
-
-                rc = cmd([self.pkg_man] + args)
-                if rc != 0:
-                    raise Exception("Failed to set proxy for repo", r['alias'], r['url'], proxy)
-
-            if "gpg" in r:
-                # Using rpm apparently works for both Yum- and Zypper-based distros.
-                args = []
-                if proxy != "":
-                    arg_env = os.environ.copy()
-                    arg_env['https_proxy'] = proxy
-                args.append("--root="+self.mname)
-                args.append("--import")
-                args.append(r["gpg"])
+    @traced('installer.install_scratch_gpg_keys')
+    def install_scratch_gpg_keys(self, repos, proxy):
+        """Imports the gpg keys of the repos into the rpm database of the mounted container"""
+        keys = gpg_keys(repos)
+        if len(keys) == 0:
+            return
+        # Using rpm apparently works for both Yum- and Zypper-based distros.
+        arg_env = None
+        if self.repo_proxy:
+            arg_env = self._proxy_env()
+        elif proxy != "":
+            arg_env = os.environ.copy()
+            arg_env['https_proxy'] = proxy
+        args = []
+        args.append("--root="+self.mname)
+        args.append("--import")
+        args.extend(keys)
 
-                rc = cmd(["rpm"] + args)
-                if rc != 0:
-                    raise Exception("Failed to install gpg key for", r['alias'], "at URL", r['gpg'])
+        rc = cmd(["rpm"] + args, env=arg_env)
+        if rc != 0:
+            raise Exception("Failed to install gpg keys", ' '.join(keys))
 
-    def install_scratch_packages(self, packages, registry_loc, proxy):
+    @traced('installer.install_scratch_packages')
+    def install_scratch_packages(self, packages, registry_loc, proxy, locked=False):
         # check if there are packages to install
         if len(packages) == 0:
             logging.warn("PACKAGES: no packages passed to install\n")
@@ -108,19 +205,26 @@ class Installer:
             args.append("-D")
             args.append(os.path.join(self.mname, pathmod.sep_strip(registry_loc)))
             args.append("-C")
-            args.append(self.tdir)
+            args.append(self.cachedir)
             args.append("--no-gpg-checks")
             args.append("--installroot")
             args.append(self.mname)
             args.append("install")
             args.append("-l")
+            if locked:
+                args.extend(self._locked_args())
             args.extend(packages)
         elif self.pkg_man == "dnf":
             args.append("--setopt=reposdir="+os.path.join(self.mname, pathmod.sep_strip(registry_loc)))
             args.append("--setopt=logdir="+os.path.join(self.tdir, self.pkg_man, "log"))
-            args.append("--setopt=cachedir="+os.path.join(self.tdir, self.pkg_man, "cache"))
+            args.append("--setopt=cachedir="+self.cachedir)
             if proxy != "":
                 args.append("--setopt=proxy="+proxy)
+            args.extend(self._cache_args())
+            args.extend(self._proxy_args())
+            args.extend(self._nodocs_args())
+            if locked:
+                args.extend(self._locked_args())
             args.append("install")
             args.append("-y")
             args.append("--nogpgcheck")
@@ -128,13 +232,14 @@ class Installer:
             args.append(self.mname)
             args.extend(packages)
 
-        rc = cmd([self.pkg_man] + args)
+        rc = self._run_pkg_man([self.pkg_man] + args)
         if rc == 104:
             raise Exception("Installing base packages failed")
 
         if rc == 107:
             logging.warn("one or more RPM postscripts failed to run")
 
+    @traced('installer.install_scratch_package_groups')
     def install_scratch_package_groups(self, package_groups, registry_loc, proxy):
         # check if there are packages groups to install
         if len(package_groups) == 0:
@@ -150,9 +255,12 @@ class Installer:
         elif self.pkg_man == "dnf":
             args.append("--setopt=reposdir="+os.path.join(self.mname, pathmod.sep_strip(registry_loc)))
             args.append("--setopt=logdir="+os.path.join(self.tdir, self.pkg_man, "log"))
-            args.append("--setopt=cachedir="+os.path.join(self.tdir, self.pkg_man, "cache"))
+            args.append("--setopt=cachedir="+self.cachedir)
             if proxy != "":
                 args.append("--setopt=proxy="+proxy)
+            args.extend(self._cache_args())
+            args.extend(self._proxy_args())
+            args.extend(self._nodocs_args())
             args.append("groupinstall")
             args.append("-y")
             args.append("--nogpgcheck")
@@ -160,10 +268,11 @@ class Installer:
             args.append(self.mname)
             args.extend(package_groups)
 
-        rc = cmd([self.pkg_man] + args)
+        rc = self._run_pkg_man([self.pkg_man] + args)
         if rc == 104:
             raise Exception("Installing base packages failed")
 
+    @traced('installer.install_scratch_modules')
     def install_scratch_modules(self, modules, registry_loc, proxy):
         # check if there are modules groups to install
         if len(modules) == 0:
@@ -180,9 +289,12 @@ class Installer:
             elif self.pkg_man == "dnf":
                 args.append("--setopt=reposdir="+os.path.join(self.mname, pathmod.sep_strip(registry_loc)))
                 args.append("--setopt=logdir="+os.path.join(self.tdir, self.pkg_man, "log"))
-                args.append("--setopt=cachedir="+os.path.join(self.tdir, self.pkg_man, "cache"))
+                args.append("--setopt=cachedir="+self.cachedir)
                 if proxy != "":
                     args.append("--setopt=proxy="+proxy)
+                args.extend(self._cache_args())
+                args.extend(self._proxy_args())
+                args.extend(self._nodocs_args())
                 args.append("module")
                 args.append(mod_cmd)
                 args.append("-y")
@@ -190,10 +302,11 @@ class Installer:
                 args.append("--installroot")
                 args.append(self.mname)
                 args.extend(mod_list)
-            rc = cmd([self.pkg_man] + args)
+            rc = self._run_pkg_man([self.pkg_man] + args)
             if rc != 0:
                 raise Exception("Failed to run module cmd", mod_cmd, ' '.join(mod_list))
             
+    @traced('installer.install_repos')
     def install_repos(self, repos, proxy):
         # check if there are repos passed for install
         if len(repos) == 0:
@@ -201,62 +314,63 @@ class Installer:
             return
 
         logging.info(f"REPOS: Installing these repos to {self.cname}")
-        for r in repos:
-            logging.info(r['alias'] + ': ' + r['url'])
-            if self.pkg_man == "zypper":
-                if 'priority' in r:
-                    priority = r['priority']
-                else:
-                    priority = 99
-                rargs = ' addrepo -f -p ' + priority + ' ' + r['url'] + ' ' + r['alias']
-            elif self.pkg_man == "dnf":
-                rargs = ' config-manager --save --add-repo ' + r['url']
+        if self.pkg_man == "zypper":
+            repo_dest = "/etc/zypp/repos.d"
+        else:
+            repo_dest = "/etc/yum.repos.d"
+        if self.repo_proxy and self.pkg_man == "zypper":
+            # zypper cannot override the proxy of a repo, and the repo proxy forwards to it anyway
+            proxy = ""
+        # Write the repo files locally and copy them all in at once
+        staging = os.path.join(self.tdir, "repos")
+        try:
+            write_repo_files(repos, staging, self.pkg_man, proxy, keep_packages=self.pkg_cache is not None)
+        except Exception as e:
+            raise Exception("Failed to install repos", e)
+        rc = cmd(["buildah","copy", self.cname, staging, repo_dest])
+        if rc != 0:
+            raise Exception("Failed to install repos to", repo_dest)
 
-            args = [self.cname, '--', 'bash', '-c', self.pkg_man + rargs]
-            rc = cmd(["buildah","run"] + args)
-            if rc != 0:
-                raise Exception("Failed to install repo", r['alias'], r['url'])
-            # Set Proxy if using DNF
-            if proxy != "":
-                if r['url'].endswith('.repo'):
-                    repo_name = r['url'].split('/')[-1].split('.repo')[0] + "*"
-                elif r['url'].startswith('https'):
-                    repo_name = r['url'].split('https://')[1].replace('/','_')
-                elif r['url'].startswith('http'):
-                    repo_name = r['url'].split('http://')[1].replace('/','_')
-                pargs = ' config-manager --save --setopt=*.proxy= ' + proxy + ' ' + repo_name
-
-                args = [self.cname, '--', 'bash', '-c', self.pkg_man + pargs]
-                rc = cmd(["buildah","run"] + args)
-                if rc != 0:
-                    raise Exception("Failed to set proxy for repo", r['alias'], r['url'], proxy)
-
-            if "gpg" in r:
-                # Using rpm apparently works for both Yum- and Zypper-based distros.
-                gargs = [self.cname, '--', 'bash', '-c', 'rpm --import ' + r['gpg']]
-                if proxy != "":
-                    arg_env = os.environ.copy()
-                    arg_env['https_proxy'] = proxy
-                rc = cmd(["buildah","run"] + gargs)
-                if rc != 0:
-                    raise Exception("Failed to install gpg key for", r['alias'], "at URL", r['gpg'])
+    @traced('installer.install_gpg_keys')
+    def install_gpg_keys(self, repos, proxy):
+        """Imports the gpg keys of the repos into the rpm database of the container"""
+        keys = gpg_keys(repos)
+        if len(keys) == 0:
+            return
+        # Using rpm apparently works for both Yum- and Zypper-based distros.
+        build_cmd = ["buildah","run"]
+        if self.repo_proxy:
+            build_cmd.extend(self._run_args())
+        elif proxy != "":
+            build_cmd.extend(["--env", "https_proxy=" + proxy])
+        gargs = [self.cname, '--', 'rpm', '--import'] + keys
+        rc = cmd(build_cmd + gargs)
+        if rc != 0:
+            raise Exception("Failed to install gpg keys", ' '.join(keys))
 
-    def install_packages(self, packages):
+    @traced('installer.install_packages')
+    def install_packages(self, packages, locked=False):
         if len(packages) == 0:
             logging.warn("PACKAGE GROUPS: no package groups passed to install\n")
             return
         logging.info(f"PACKAGES: Installing these packages to {self.cname}")
         logging.info("\n".join(packages))
         args = [self.cname, '--', 'bash', '-c']
-        pkg_cmd =  [self.pkg_man]
+        pkg_cmd =  [self.pkg_man] + self._cache_args() + self._proxy_args() + self._nodocs_args()
         if self.gpgcheck is not True:
             if self.pkg_man == 'dnf':
                 pkg_cmd.append('--nogpgcheck')
             elif self.pkg_man == 'zypper':
                 pkg_cmd.append('--no-gpg-checks')
-        args.append(" ".join(pkg_cmd + [ 'install', '-y'] + packages))
-        cmd(["buildah","run"] + args)
+        if locked and self.pkg_man == 'dnf':
+            pkg_cmd.extend(self._locked_args())
+        install_cmd = ['install', '-y']
+        if locked and self.pkg_man == 'zypper':
+            install_cmd.extend(self._locked_args())
+        args.append(" ".join(pkg_cmd + install_cmd + packages))
+        self._run_pkg_man(["buildah","run"] + self._run_args() + args)
 
+    @traced('installer.install_package_groups')
     def install_package_groups(self, package_groups):
         if len(package_groups) == 0:
             logging.warn("PACKAGE GROUPS: no package groups passed to install\n")
@@ -264,14 +378,15 @@ class Installer:
         logging.info(f"PACKAGES: Installing these package groups to {self.cname}")
         logging.info("\n".join(package_groups))
         args = [self.cname, '--', 'bash', '-c']
-        pkg_cmd = [self.pkg_man, 'groupinstall', '-y']
+        pkg_cmd = [self.pkg_man] + self._cache_args() + self._proxy_args() + self._nodocs_args() + ['groupinstall', '-y']
         if self.pkg_man == "zypper":
             logging.warn("zypper does not support package groups")
         if self.gpgcheck is not True:
             pkg_cmd.append('--nogpgcheck')
         args.append(" ".join(pkg_cmd + [f'"{pg}"' for pg in package_groups]))
-        cmd(["buildah","run"] + args)
+        self._run_pkg_man(["buildah","run"] + self._run_args() + args)
         
+    @traced('installer.remove_packages')
     def remove_packages(self, remove_packages):
         # check if there are packages to remove
         if len(remove_packages) == 0:
@@ -280,44 +395,190 @@ class Installer:
 
         logging.info(f"REMOVE PACKAGES: removing these packages from container {self.cname}")
         logging.info("\n".join(remove_packages))
+
+        # Check which packages are installed and remove those in a single rpm
+        # transaction, all inside one container session.
+        script = (
+            'installed=(); '
+            'for p in "$@"; do '
+            'if rpm -q --quiet "$p"; then echo "installed $p"; installed+=("$p"); '
+            'else echo "missing $p"; fi; '
+            'done; '
+            'if [ ${#installed[@]} -gt 0 ]; then rpm -e --nodeps "${installed[@]}"; fi'
+        )
+        status = {}
+        def rpm_handler(line):
+            state, _, name = line.partition(' ')
+            if state in ("installed", "missing") and name in remove_packages:
+                status[name] = state == "installed"
+            else:
+                logging.info(line)
+
+        run_cmd, kwargs = self._exec(['bash', '-c', script, 'bash'] + remove_packages)
+        cmd(run_cmd, stdout_handler=rpm_handler, **kwargs)
+
         for p in remove_packages:
-            args = [self.cname, '--', 'rpm', '-e', '--nodeps', p]
-            cmd(["buildah","run"] + args)
+            if status.get(p):
+                logging.info(f"REMOVE PACKAGES: removed {p}")
+            else:
+                logging.warn(f"REMOVE PACKAGES: {p} is not installed, skipping")
+        return status
 
-    def install_commands(self, commands):
+    def _cmd_loglevel(self, c):
+        if 'loglevel' in c:
+            if c['loglevel'].upper() == "INFO":
+                return logging.info
+            elif c['loglevel'].upper() == "WARN":
+                return logging.warn
+            else:
+                return logging.error
+        return logging.error
+
+    @traced('installer.install_commands')
+    def install_commands(self, commands, batch=False):
+        """
+        Runs commands in the container, one 'buildah run' each or batched
+
+        Returns:
+            list: {'cmd', 'rc', 'duration'} for every command, with rc and
+                  duration None for commands that did not run
+        """
         # check if there are commands to install
         if len(commands) == 0:
             logging.warn("COMMANDS: no commands passed to run\n")
-            return
+            return []
 
         logging.info(f"COMMANDS: running these commands in {self.cname}")
+        if batch:
+            return self._install_commands_batched(commands)
+
+        results = []
         for c in commands:
             logging.info(c['cmd'])
-            build_cmd = ["buildah","run"]
-            if 'buildah_extra_args' in c:
-              build_cmd.extend(c['buildah_extra_args'])
-            args = [self.cname, '--', 'bash', '-c', c['cmd']]
-            if 'loglevel' in c:
-                if c['loglevel'].upper() == "INFO":
-                    loglevel = logging.info
-                elif c['loglevel'].upper() == "WARN":
-                    loglevel = logging.warn
+            run_cmd, kwargs = self._exec(['bash', '-c', c['cmd']], c.get('buildah_extra_args'))
+            start = time.monotonic()
+            rc = cmd(run_cmd, stderr_handler=self._cmd_loglevel(c), **kwargs)
+            results.append({'cmd': c['cmd'], 'rc': rc, 'duration': time.monotonic() - start})
+            logging.info(f"COMMANDS: [rc={rc}, {results[-1]['duration']:.2f}s] {c['cmd']}")
+        return results
+
+    def _install_commands_batched(self, commands):
+        """
+        Runs consecutive commands with the same buildah_extra_args in one
+        'buildah run' session. Each command still runs in its own shell, and
+        its exit status and duration are reported separately. The session stops
+        at the first failing command, like the unbatched mode does.
+        """
+        # Group consecutive commands by their buildah_extra_args
+        groups = []
+        for c in commands:
+            extra_args = c.get('buildah_extra_args', [])
+            if groups and groups[-1][0] == extra_args:
+                groups[-1][1].append(c)
+            else:
+                groups.append((extra_args, [c]))
+
+        results = []
+        for extra_args, group in groups:
+            results.extend(self._run_command_session(extra_args, group))
+        return results
+
+    def _run_command_session(self, extra_args, commands):
+        marker = "@@image-build-" + uuid.uuid4().hex
+        script = (
+            'marker=$1; shift; i=0; '
+            'for c in "$@"; do '
+            'echo "$marker start $i"; echo "$marker start $i" >&2; '
+            'bash -c "$c"; rc=$?; '
+            'echo "$marker end $i $rc"; echo "$marker end $i $rc" >&2; '
+            'if [ $rc -ne 0 ] && [ $rc -ne 107 ]; then exit $rc; fi; '
+            'i=$((i+1)); '
+            'done'
+        )
+        results = [{'cmd': c['cmd'], 'rc': None, 'duration': None} for c in commands]
+        current = {'stdout': None, 'stderr': None}
+        started = {}
+
+        def handle(stream, line, default_handler):
+            text, found, ctl = line.partition(marker)
+            idx = current[stream]
+            if text:
+                if idx is None:
+                    default_handler(text)
+                elif stream == 'stderr':
+                    self._cmd_loglevel(commands[idx])(text)
                 else:
-                    loglevel = logging.error
+                    logging.info(text)
+            if not found:
+                return
+            ctl = ctl.split()
+            if ctl[0] == "start":
+                current[stream] = int(ctl[1])
+                if stream == 'stdout':
+                    logging.info(commands[int(ctl[1])]['cmd'])
+                    started[int(ctl[1])] = time.monotonic()
             else:
-                loglevel = logging.error
-            cmd(["buildah","run"] + args, stderr_handler=loglevel)
+                current[stream] = None
+                if stream == 'stdout':
+                    i = int(ctl[1])
+                    results[i]['rc'] = int(ctl[2])
+                    results[i]['duration'] = time.monotonic() - started[i]
 
-    def install_copyfiles(self, copyfiles):
+        run_cmd, kwargs = self._exec(['bash', '-c', script, 'bash', marker] + [c['cmd'] for c in commands], extra_args)
+        rc = cmd(run_cmd,
+                 stdout_handler=lambda line: handle('stdout', line, logging.info),
+                 stderr_handler=lambda line: handle('stderr', line, logging.error),
+                 check=False, **kwargs)
+
+        for r in results:
+            if r['rc'] is None:
+                logging.info(f"COMMANDS: [not run] {r['cmd']}")
+            else:
+                logging.info(f"COMMANDS: [rc={r['rc']}, {r['duration']:.2f}s] {r['cmd']}")
+        if rc and rc != 107:
+            raise subprocess.CalledProcessError(rc, run_cmd)
+        return results
+
+    @traced('installer.install_copyfiles')
+    def install_copyfiles(self, copyfiles, hardlink=False):
         if len(copyfiles) == 0:
             logging.warn("COPYFILES: no files to copy\n")
             return
         logging.info(f"COPYFILES: copying these files to {self.cname}")
+
+        # Copy straight into the rootfs when it is mounted
+        copier = RootfsCopier(self.mname, hardlink) if self.mname else None
+        # Consecutive sources for the same directory share one `buildah copy`
+        batch = {'opts': None, 'dest': None, 'srcs': []}
+
+        def flush():
+            if batch['srcs']:
+                cmd(["buildah","copy"] + batch['opts'] + [self.cname] + batch['srcs'] + [batch['dest']])
+            batch['srcs'] = []
+
         for f in copyfiles:
             args = []
             if 'opts' in f:
                 for o in f['opts']:
                     args.extend(o.split())
             logging.info(f['src'] + ' -> ' + f['dest'])
-            args +=  [ self.cname, f['src'], f['dest'] ]
-            cmd(["buildah","copy"] + args)
+            opts = parse_opts(f.get('opts', []))
+            if copier and copier.supports(f['src'], opts):
+                flush()
+                try:
+                    copier.copy(f['src'], f['dest'], opts)
+                    continue
+                except UnsupportedCopy as e:
+                    logging.info(f"COPYFILES: {e}, using buildah copy")
+            if not (batch['srcs'] and batch['opts'] == args and batch['dest'] == f['dest']
+                    and batchable(f['src'], f['dest']) and batchable(batch['srcs'][-1], f['dest'])):
+                flush()
+                batch['opts'] = args
+                batch['dest'] = f['dest']
+            batch['srcs'].append(f['src'])
+        flush()
+
+        if copier:
+            s = copier.stats
+            logging.info(f"COPYFILES: {s['reflinked']} files reflinked, {s['hardlinked']} hardlinked, "
+                         f"{s['copied']} copied ({s['bytes'] / 1024**2:.1f} MiB)")
@@ -5,10 +5,20 @@ import os
 # written modules
 from image_config import ImageConfig
 from utils import cmd, run_playbook
-from publish import publish
+from publish import publish, publish_cached
+from build_cache import BuildCache, fingerprint
 import installer
 import logging
 from oscap import Oscap
+from chroot_exec import ChrootSession
+from fact_cache import FactCache
+from slim import Slimmer
+import size_report
+from pkg_cache import PackageCache
+import lockfile
+from repo_proxy import RepoProxy
+from steps import StepGraph, StepError
+from tracing import span, traced
 
 
 class Layer:
@@ -17,7 +27,8 @@ class Layer:
         self.image_config = image_config
         self.logger = logging.getLogger(__name__)
 
-    def _build_base(self, repos, modules, packages, package_groups, remove_packages, commands, copyfiles, oscap_options):
+    @traced('layer.build_base')
+    def _build_base(self, repos, modules, packages, package_groups, remove_packages, commands, copyfiles, oscap_options, slim_options):
         # Set local variables
         dt_string = datetime.now().strftime("%Y%m%d%H%M%S")
         parent = self.args['parent']
@@ -33,6 +44,19 @@ class Layer:
         else:
             proxy = ""
 
+        # Install exactly the packages of the lockfile
+        lock = None
+        if self.args['locked']:
+            try:
+                lock = lockfile.load(self.args['lockfile'], package_manager)
+            except ValueError as e:
+                self.logger.error(f"Error loading lockfile: {e}")
+                sys.exit("Exiting now ...")
+            self.logger.info(f"Installing the {len(lock['packages'])} packages locked in {self.args['lockfile']}")
+            # The lockfile already lists every package the groups brought in
+            packages = [lockfile.package_spec(p, package_manager) for p in lock['packages']]
+            package_groups = []
+
         # container and mount name
         def buildah_handler(line):
             out.append(line)
@@ -89,9 +113,26 @@ class Layer:
         else:
             self.logger.error("unsupported package manager")
 
+        pkg_cache = None
+        if self.args['pkg_cache']:
+            pkg_cache = PackageCache(self.args['pkg_cache'], package_manager,
+                                     self.args['pkg_cache_max_size'], self.args['pkg_cache_max_age'])
+
+        repo_proxy = None
+        if self.args['repo_proxy_cache']:
+            # Forwards to the configured proxy, if any
+            repo_proxy = RepoProxy(self.args['repo_proxy_cache'], self.args['repo_proxy_max_size'], proxy)
+            repo_proxy.start()
+
+        # Run commands in the mounted rootfs with chroot instead of `buildah run`
+        chroot = None
+        if parent == "scratch" and self.args['exec_backend'] == "chroot":
+            chroot = ChrootSession(mname)
+
         inst = None
         try:
-            inst = installer.Installer(package_manager, cname, mname, gpgcheck)
+            inst = installer.Installer(package_manager, cname, mname, gpgcheck, pkg_cache,
+                                       repo_proxy.url if repo_proxy else "", chroot, bool(slim_options.get('docs')))
         except Exception as e:
             self.logger.error(f"Error preparing installer: {e}")
             cmd(["buildah","rm"] + [cname])
@@ -101,113 +142,295 @@ class Layer:
             cmd(["buildah","rm"] + [cname])
             sys.exit("Exiting now ...")
 
-        # Install Repos
+        # The temporary directory is removed and the package cache evicted however the build ends
         try:
-            if parent == "scratch":
-                inst.install_scratch_repos(repos, repo_dest, proxy)
+            # The build steps, and the steps each of them has to wait for. Steps
+            # that do not depend on each other run at the same time.
+            scratch = parent == "scratch"
+            graph = StepGraph(self.args['step_jobs'])
+            locked = lock is not None
+            base_packages = []
+            repo_state = []
+            if self.args['lockfile']:
+                # The lockfile only lists the packages installed on top of the parent
+                if not scratch:
+                    graph.add('base_packages', lambda: base_packages.extend(inst.installed_packages()),
+                              description="listing the packages of the parent")
+                graph.add('repo_identities', lambda: repo_state.extend(lockfile.repo_identities(repos, proxy)),
+                          description="identifying repos")
+            if scratch:
+                graph.add('repos', lambda: inst.install_scratch_repos(repos, repo_dest, proxy),
+                          description="installing repos")
+                graph.add('gpg_keys', lambda: inst.install_scratch_gpg_keys(repos, proxy),
+                          description="installing gpg keys")
+                graph.add('modules', lambda: inst.install_scratch_modules(modules, repo_dest, proxy),
+                          after=['repos', 'gpg_keys'], description="installing packages")
+                graph.add('package_groups', lambda: inst.install_scratch_package_groups(package_groups, repo_dest, proxy),
+                          after=['modules'], description="installing packages")
+                graph.add('packages', lambda: inst.install_scratch_packages(packages, repo_dest, proxy, locked),
+                          after=['package_groups'], description="installing packages")
             else:
-                inst.install_repos(repos, proxy)
-        except Exception as e:
-            self.logger.error(f"Error installing repos: {e}")
-            cmd(["buildah","rm"] + [cname])
-            sys.exit("Exiting now ...")
-        except KeyboardInterrupt:
-            self.logger.error(f"Keyboard Interrupt")
-            cmd(["buildah","rm"] + [cname])
-            sys.exit("Exiting now ...")
+                graph.add('repos', lambda: inst.install_repos(repos, proxy),
+                          description="installing repos")
+                graph.add('gpg_keys', lambda: inst.install_gpg_keys(repos, proxy),
+                          description="installing gpg keys")
+                graph.add('package_groups', lambda: inst.install_package_groups(package_groups),
+                          after=['repos', 'gpg_keys'] + (['base_packages'] if 'base_packages' in graph else []),
+                          description="installing packages")
+                graph.add('packages', lambda: inst.install_packages(packages, locked),
+                          after=['package_groups'], description="installing packages")
+            installed = []
+            if self.args['lockfile']:
+                # The lockfile lists what the packages, groups and modules brought in,
+                # before remove_packages, cmds or slimming change the rootfs
+                def lock_snapshot():
+                    base = set(base_packages)
+                    installed.extend(p for p in inst.installed_packages() if p not in base)
+                    if lock:
+                        lockfile.check_repos(lock, repo_state)
+                        if not lockfile.check_packages(lock, installed):
+                            raise Exception(f"the installed packages differ from {self.args['lockfile']}")
+                graph.add('lock_snapshot', lock_snapshot, after=['packages', 'repo_identities'],
+                          description="checking the packages against the lockfile" if lock else "listing the installed packages")
+            graph.add('remove_packages', lambda: inst.remove_packages(remove_packages),
+                      after=['lock_snapshot' if 'lock_snapshot' in graph else 'packages'], description="removing packages")
+            # Packages may own the same paths, so files are copied once they are installed
+            graph.add('copyfiles', lambda: inst.install_copyfiles(copyfiles, self.args['copyfiles_hardlink']),
+                      after=['remove_packages'], description="copying files")
 
-        # Install Packages
-        try:
-            if parent == "scratch":
-                # Enable modules
-                inst.install_scratch_modules(modules, repo_dest, self.args['proxy'])
-                # Base Package Groups
-                inst.install_scratch_package_groups(package_groups, repo_dest, proxy)
-                # Packages
-                inst.install_scratch_packages(packages, repo_dest, proxy)
-            else:
-                inst.install_package_groups(package_groups)
-                inst.install_packages(packages)
-            # Remove Packages
-            inst.remove_packages(remove_packages)
-        except Exception as e:
-            self.logger.error(f"Error installing packages: {e}")
-            cmd(["buildah","rm"] + [cname])
-            sys.exit("Exiting now ...")
-        except KeyboardInterrupt:
-            self.logger.error(f"Keyboard Interrupt")
-            cmd(["buildah","rm"] + [cname])
-            sys.exit("Exiting now ...")
+            def run_commands():
+                inst.install_commands(commands, self.args['batch_cmds'])
+                if os.path.islink(mname + '/etc/resolv.conf'):
+                    self.logger.info("removing resolv.conf link (this link breaks running a container)")
+                    os.unlink(mname + '/etc/resolv.conf')
+            commands_after = ['copyfiles']
+            if chroot:
+                # Mounted once the packages and files are in place, for every command after that
+                graph.add('chroot_setup', chroot.setup, after=['copyfiles'], description="setting up the chroot")
+                commands_after.append('chroot_setup')
+            graph.add('commands', run_commands, after=commands_after, description="running commands")
+
+            # OpenSCAP
+            if self.args['install_scap'] or self.args['scap_benchmark'] or self.args['oval_eval']:
+                oscap = Oscap(oscap_options, self.args, inst, repo_dest)
+                last = 'commands'
+                if self.args['install_scap']:
+                    graph.add('install_scap', oscap.install_scap, after=[last], description="installing openscap")
+                    last = 'install_scap'
+                graph.add('check_scap', oscap.check_install, after=[last], description="checking openscap")
+                if self.args['scap_benchmark']:
+                    graph.add('scap_benchmark', oscap.run_oscap, after=['check_scap'], description="running the SCAP benchmark")
+                if self.args['oval_eval']:
+                    # The OVAL definitions are downloaded while the image is built
+                    graph.add('fetch_oval', oscap.fetch_oval, description="downloading OVAL definitions")
+                    graph.add('oval_eval', oscap.run_oval_eval, after=['check_scap', 'fetch_oval'],
+                              description="running the OVAL evaluation")
+
+            try:
+                try:
+                    graph.run()
+                finally:
+                    # Unmount before anything removes the container
+                    if chroot:
+                        chroot.teardown()
+                    if repo_proxy:
+                        repo_proxy.stop()
+            except StepError as e:
+                self.logger.error(f"Error {e}")
+                cmd(["buildah","rm"] + [cname])
+                sys.exit("Exiting now ...")
+            except KeyboardInterrupt:
+                self.logger.error(f"Keyboard Interrupt")
+                cmd(["buildah","rm"] + [cname])
+                sys.exit("Exiting now ...")
+
+            # Slimming runs once nothing is mounted into the rootfs anymore
+            if slim_options:
+                try:
+                    self._slim(cname, mname, slim_options)
+                except Exception as e:
+                    self.logger.error(f"Error slimming the image: {e}")
+                    cmd(["buildah","rm"] + [cname])
+                    sys.exit("Exiting now ...")
+
+            if self.args['lockfile'] and not lock:
+                try:
+                    lockfile.write(self.args['lockfile'], container, parent, package_manager, installed, repo_state)
+                except Exception as e:
+                    self.logger.error(f"Error writing lockfile: {e}")
+                    cmd(["buildah","rm"] + [cname])
+                    sys.exit("Exiting now ...")
 
-        # Copy Files
+            return cname
+        finally:
+            inst.cleanup()
+
+    def _slim(self, cname, mname, slim_options):
+        """Removes what slim_options asks for from the rootfs, mounting it if needed"""
+        def buildah_handler(line):
+            out.append(line)
+
+        mounted = False
+        if not mname:
+            out = []
+            cmd(["buildah", "mount"] + [cname], stdout_handler = buildah_handler)
+            mname = out[0]
+            mounted = True
         try:
-            inst.install_copyfiles(copyfiles)
-        except Exception as e:
-            self.logger.error(f"Error running commands: {e}")
-            cmd(["buildah","rm"] + [cname])
-            sys.exit("Exiting now")
-        except KeyboardInterrupt:
-            self.logger.error(f"Keyboard Interrupt")
-            cmd(["buildah","rm"] + [cname])
-            sys.exit("Exiting now ...")
+            Slimmer(mname, slim_options).run()
+        finally:
+            if mounted:
+                cmd(["buildah", "umount"] + [cname], check=False)
 
-        # Run Commands
+    def _report_size(self, cname, args):
+        """
+        Logs where the space in the image goes and what changed since the
+        previous build of the same name, and stores the summary for the next
+        build. The report never fails the build.
+        """
+        def buildah_handler(line):
+            out.append(line)
+
+        tags = args['publish_tags'] if type(args['publish_tags']) is list else [args['publish_tags']]
+        out = []
         try:
-            inst.install_commands(commands)
-            if os.path.islink(mname + '/etc/resolv.conf'):
-                self.logger.info("removing resolv.conf link (this link breaks running a container)")
-                os.unlink(mname + '/etc/resolv.conf')
+            cmd(["buildah", "mount"] + [cname], stdout_handler = buildah_handler)
+            try:
+                summary = size_report.summarize(out[0], args['name'], tags[0])
+            finally:
+                cmd(["buildah", "umount"] + [cname], check=False)
+            for line in size_report.format_summary(summary):
+                self.logger.info("SIZE: " + line)
+            previous = size_report.load_previous(args['size_report'], args['name'])
+            if previous:
+                for line in size_report.diff(previous, summary):
+                    self.logger.info("SIZE: " + line)
+            path = size_report.save(summary, args['size_report'])
+            self.logger.info(f"SIZE: stored the summary as {path}")
         except Exception as e:
-            self.logger.error(f"Error running commands: {e}")
-            cmd(["buildah","rm"] + [cname])
-            sys.exit("Exiting now")
-        except KeyboardInterrupt:
-            self.logger.error(f"Keyboard Interrupt")
-            cmd(["buildah","rm"] + [cname])
-            sys.exit("Exiting now ...")
-        
-        # OpenSCAP 
-        if self.args['install_scap'] or self.args['scap_benchmark'] or self.args['oval_eval']: 
-            oscap = Oscap(oscap_options, self.args, inst)
-            if self.args['install_scap']:
-                oscap.install_scap()
-            oscap.check_install()
-            if self.args['scap_benchmark']:
-                oscap.run_oscap()
-            if self.args['oval_eval']:
-                oscap.run_oval_eval()
-
-        return cname
-
-    def _build_ansible(self, target, parent, ansible_groups, ansible_pb, ansible_inv, ansible_vars, ansible_verbosity):
+            self.logger.warn(f"SIZE: could not report the size of {args['name']}: {e}")
+
+    def _ansible_targets(self):
+        """
+        Returns the images an ansible layer builds, as the arguments to build
+        and publish each of them with. Without 'targets' in the config, the
+        layer builds the one image described by the options.
+        """
+        config_targets = self.image_config.get_targets()
+        if not config_targets:
+            return [self.args]
+
+        base_vars = self.args['ansible_vars'] if isinstance(self.args['ansible_vars'], dict) else {}
+        targets = []
+        names = set()
+        for t in config_targets:
+            if 'name' not in t:
+                raise ValueError("every entry in 'targets' needs a 'name'")
+            if t['name'] in names:
+                raise ValueError(f"target '{t['name']}' is listed more than once")
+            # All targets are configured by one playbook run, where every play
+            # runs on whichever targets its hosts pattern matches
+            if 'playbooks' in t:
+                raise ValueError(f"target '{t['name']}' sets 'playbooks', but all targets run the "
+                                 "playbooks of the options; use 'groups' and 'vars' to tell them apart")
+            names.add(t['name'])
+            args = dict(self.args)
+            args['name'] = t['name']
+            args['parent'] = t.get('parent', self.args['parent'])
+            args['publish_tags'] = t.get('publish_tags', self.args['publish_tags'])
+            args['ansible_groups'] = t.get('groups', self.args['ansible_groups'])
+            # Target vars are added to the vars of the options
+            args['ansible_vars'] = dict(base_vars, **t.get('vars', {}))
+            targets.append(args)
+        return targets
+
+    @traced('layer.build_ansible')
+    def _build_ansible(self, targets, ansible_inv, ansible_verbosity):
+        """
+        Creates a container for every target and configures all of them in a
+        single playbook run
+
+        Returns:
+            dict: target name to container name
+        """
+        containers = {}
         cnames = {}
+        sessions = []
+        mounted = []
+        connection = self.args['ansible_connection']
+        fact_cache = FactCache(self.args['ansible_fact_cache']) if self.args['ansible_fact_cache'] else None
         def buildah_handler(line):
             out.append(line)
 
-        out = []
-        cmd(["buildah","from"] + self.args['registry_opts_pull'] + ["--name", target, parent], stdout_handler = buildah_handler)
-        container_name = out[0]
+        try:
+            for t in targets:
+                out = []
+                cmd(["buildah","from"] + t['registry_opts_pull'] + ["--name", t['name'], t['parent']], stdout_handler = buildah_handler)
+                container_name = out[0]
+                containers[t['name']] = container_name
 
-        cnames[container_name] = { 
-                'ansible_groups': ansible_groups, 
-                'ansible_pb': ansible_pb, 
-                'ansible_vars': ansible_vars 
-                }
+                cnames[container_name] = {
+                        'ansible_groups': t['ansible_groups'],
+                        'ansible_pb': t['ansible_pb'],
+                        'ansible_vars': t['ansible_vars']
+                        }
 
-        try:
-            pb_res = run_playbook(cnames, ansible_inv, ansible_verbosity)
+                if connection == "chroot":
+                    # Run the modules in the mounted rootfs instead of through buildah
+                    out = []
+                    cmd(["buildah","mount"] + [container_name], stdout_handler = buildah_handler)
+                    mounted.append(container_name)
+                    session = ChrootSession(out[0])
+                    session.setup()
+                    sessions.append(session)
+                    cnames[container_name].update({
+                        'ansible_connection': "community.general.chroot",
+                        'ansible_host': out[0],
+                        'ansible_pipelining': True
+                        })
+
+                if fact_cache:
+                    out = []
+                    cmd(["buildah","inspect","--format","{{.FromImageDigest}}"] + [container_name], stdout_handler = buildah_handler)
+                    if out and out[0]:
+                        cnames[container_name]['fact_cache_key'] = out[0]
+
+            pb_res = run_playbook(cnames, ansible_inv, ansible_verbosity, fact_cache)
         except Exception as e:
             self.logger.error(e)
-            cmd(["buildah","rm"] + [target])
+            self._unmount_ansible(sessions, mounted)
+            for container_name in containers.values():
+                cmd(["buildah","rm"] + [container_name])
             self.logger.error("Exiting Now...")
             sys.exit(1)
-        return container_name
+        self._unmount_ansible(sessions, mounted)
+        return containers
+
+    def _unmount_ansible(self, sessions, mounted):
+        for session in sessions:
+            session.teardown()
+        for container_name in mounted:
+            cmd(["buildah","umount"] + [container_name], check=False)
 
+    @traced('layer.build_layer')
     def build_layer(self):
         print("BUILD LAYER".center(50, '-'))
 
+        cache = None
+        cache_ref = None
         if self.args['layer_type'] == "base":
-            
+            # Skip the build entirely if an identical build is cached
+            if self.args['build_cache']:
+                cache = BuildCache(self.args['build_cache'])
+                with span('layer.build_cache_lookup'):
+                    fp = fingerprint(self.image_config, self.args)
+                    entry = cache.lookup(fp, self.args)
+                if entry:
+                    self.logger.info("Publishing Layer from build cache")
+                    publish_cached(entry, self.args)
+                    return
+                cache_ref = cache.image_ref(self.args['name'], fp)
+
             repos = self.image_config.get_repos()
             modules = self.image_config.get_modules()
             packages = self.image_config.get_packages()
@@ -216,23 +439,46 @@ class Layer:
             commands = self.image_config.get_commands()
             copyfiles = self.image_config.get_copy_files()
             oscap_options = self.image_config.get_oscap_options()
+            slim_options = self.image_config.get_slim_options()
 
-            cname = self._build_base(repos, modules, packages, package_groups, remove_packages, commands, copyfiles, oscap_options)
+            cname = self._build_base(repos, modules, packages, package_groups, remove_packages, commands, copyfiles, oscap_options, slim_options)
         elif self.args['layer_type'] == "ansible":
-            layer_name = self.args['name']
-            print("Layer_Name =", layer_name)
-            parent = self.args['parent']
-            ansible_groups = self.args['ansible_groups']
-            ansible_pb = self.args['ansible_pb']
+            try:
+                targets = self._ansible_targets()
+            except ValueError as e:
+                self.logger.error(e)
+                sys.exit("Exiting now ...")
+            for t in targets:
+                print("Layer_Name =", t['name'])
             ansible_inv = self.args['ansible_inv']
-            ansible_vars = self.args['ansible_vars']
             ansible_verbosity = self.args['ansible_verbosity']
 
-            cname = self._build_ansible(layer_name, parent, ansible_groups, ansible_pb, ansible_inv, ansible_vars, ansible_verbosity)
+            containers = self._build_ansible(targets, ansible_inv, ansible_verbosity)
+
+            # Every target is published as an image of its own
+            remaining = dict(containers)
+            try:
+                for t in targets:
+                    if t['size_report']:
+                        self._report_size(containers[t['name']], t)
+                    self.logger.info(f"Publishing Layer {t['name']}")
+                    publish(containers[t['name']], t, remove_parent=False)
+                    del remaining[t['name']]
+            finally:
+                for container_name in remaining.values():
+                    cmd(["buildah","rm"] + [container_name], stderr_handler=logging.warn, check=False)
+            for parent in sorted({t['parent'] for t in targets} - {"scratch"}):
+                cmd(["buildah", "rmi", parent], stderr_handler=logging.warn)
+            return
         else:
             self.logger.error("Unrecognized layer type")
             sys.exit("Exiting now ...")
         
+        if self.args['size_report']:
+            self._report_size(cname, self.args)
+
         # Publish the layer
         self.logger.info("Publishing Layer")
-        publish(cname, self.args)
+        published = publish(cname, self.args, cache_ref)
+        if cache:
+            cache.store(fp, self.args['name'], published)
@@ -0,0 +1,125 @@
+"""
+Lockfile Module
+
+This module reads and writes package lockfiles. A lockfile records the exact
+packages (as name-epoch:version-release.arch) that a base layer build
+installed on top of its parent, and the identity of the repos they came from,
+so that a later build can install exactly the same packages.
+"""
+
+import hashlib
+import logging
+import os
+import re
+import urllib.request
+import yaml
+
+LOCKFILE_VERSION = 1
+RPM_QUERYFORMAT = '%{NAME}-%{EPOCHNUM}:%{VERSION}-%{RELEASE}.%{ARCH}\\n'
+
+def parse_nevra(nevra):
+    """Splits name-epoch:version-release.arch into its parts"""
+    nevr, _, arch = nevra.rpartition('.')
+    name, ev, release = nevr.rsplit('-', 2)
+    epoch, _, version = ev.rpartition(':')
+    return name, epoch or '0', version, release, arch
+
+def package_spec(nevra, pkg_man):
+    """Returns the argument that makes pkg_man install exactly nevra"""
+    name, epoch, version, release, arch = parse_nevra(nevra)
+    if pkg_man == "zypper":
+        evr = f"{version}-{release}" if epoch == '0' else f"{epoch}:{version}-{release}"
+        return f"{name}.{arch}={evr}"
+    return nevra
+
+def _fetch(url, proxy):
+    handlers = []
+    if proxy:
+        handlers.append(urllib.request.ProxyHandler({'http': proxy, 'https': proxy}))
+    with urllib.request.build_opener(*handlers).open(url, timeout=60) as res:
+        return res.read()
+
+def repo_identities(repos, proxy=""):
+    """
+    Identifies the current state of every repo by the checksum (and revision)
+    of its repomd.xml, or of the .repo file for repos given as one
+    """
+    identities = []
+    for r in repos:
+        identity = {'alias': r['alias'], 'url': r['url']}
+        if r['url'].endswith('.repo'):
+            url = r['url']
+        else:
+            url = r['url'].rstrip('/') + '/repodata/repomd.xml'
+        try:
+            data = _fetch(url, proxy)
+        except Exception as e:
+            logging.warn(f"LOCKFILE: could not identify repo {r['alias']}: {e}")
+        else:
+            identity['checksum'] = 'sha256:' + hashlib.sha256(data).hexdigest()
+            revision = re.search(rb'<revision>([^<]*)</revision>', data)
+            if revision:
+                identity['revision'] = revision.group(1).decode()
+        identities.append(identity)
+    return identities
+
+def write(path, name, parent, pkg_man, packages, repos):
+    lock = {
+        'version': LOCKFILE_VERSION,
+        'name': name,
+        'parent': parent,
+        'pkg_man': pkg_man,
+        'repos': repos,
+        'packages': sorted(packages),
+    }
+    with open(path + ".tmp", 'w') as f:
+        f.write("# Generated by image-build, install exactly these packages with --locked\n")
+        yaml.safe_dump(lock, f, default_flow_style=False, sort_keys=False)
+    os.replace(path + ".tmp", path)
+    logging.info(f"LOCKFILE: wrote {len(packages)} packages to {path}")
+
+def load(path, pkg_man):
+    """
+    Loads a lockfile
+
+    Raises:
+        ValueError: if the lockfile cannot be used for this build
+    """
+    try:
+        with open(path, 'r') as f:
+            lock = yaml.safe_load(f)
+    except OSError as e:
+        raise ValueError(f"cannot read lockfile {path}: {e}")
+    if not isinstance(lock, dict) or lock.get('version') != LOCKFILE_VERSION:
+        raise ValueError(f"{path} is not a version {LOCKFILE_VERSION} lockfile")
+    if lock.get('pkg_man') != pkg_man:
+        raise ValueError(f"lockfile {path} was written for {lock.get('pkg_man')}, not {pkg_man}")
+    if not lock.get('packages'):
+        raise ValueError(f"lockfile {path} does not list any packages")
+    return lock
+
+def check_repos(lock, identities):
+    """Warns about repos that changed since the lockfile was written"""
+    locked = {r['alias']: r for r in lock.get('repos', [])}
+    for r in identities:
+        old = locked.get(r['alias'])
+        if old is None:
+            logging.warn(f"LOCKFILE: repo {r['alias']} is not in the lockfile")
+        elif old.get('checksum') and r.get('checksum') and old['checksum'] != r['checksum']:
+            logging.info(f"LOCKFILE: repo {r['alias']} changed since the lockfile was written "
+                         f"(revision {old.get('revision', '?')} -> {r.get('revision', '?')})")
+
+def check_packages(lock, installed):
+    """
+    Compares the packages a locked build installed with the lockfile
+
+    Returns:
+        bool: whether they are the same
+    """
+    locked = set(lock['packages'])
+    installed = set(installed)
+    for p in sorted(installed - locked):
+        logging.warn(f"LOCKFILE: {p} was installed but is not in the lockfile")
+    for p in sorted(locked - installed):
+        logging.warn(f"LOCKFILE: {p} is in the lockfile but was not installed")
+    return locked == installed
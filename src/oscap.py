@@ -1,52 +1,78 @@
+import bz2
 import logging
+import os
+import shutil
+import urllib.request
 from utils import cmd
+from tracing import traced
 
 class Oscap:
-    def __init__(self, oscap_options, args, inst):
+    def __init__(self, oscap_options, args, inst, repo_dest=None):
         oscap_config = self._get_oscap_filepaths()
         for i in oscap_options:
             oscap_config.update(i)
         self.oscap_config = oscap_config
         self.args = args
         self.inst = inst
+        self.repo_dest = repo_dest
+        # OVAL definitions downloaded on the host by fetch_oval()
+        self.oval_file = None
         self.logger = logging.getLogger(__name__)
 
+    @traced('oscap.check_install')
     def check_install(self):
         check_install = self._check_scap_install() 
         commands = [
             {'cmd': check_install, 'loglevel': 'DEBUG'},
         ]
         try:
-            self.inst.install_base_commands(commands)
+            self.inst.install_commands(commands)
         except Exception as e:
             self.logger.error(f"openscap not found - Try installing the following: openscap-utils scap-security-guide or passing in --install-scap to image-builder: {e}")
-            cmd(["buildah","rm"] + [cname])
-            sys.exit("Exiting now")
-        except KeyboardInterrupt:
-            self.logger.error(f"Keyboard Interrupt")
-            cmd(["buildah","rm"] + [cname])
-            sys.exit("Exiting now ...") 
+            raise
 
+    @traced('oscap.install_scap')
     def install_scap(self):
-        if self.args['pkg_man'] == "zypper":
-            repo_dest = "/etc/zypp/repos.d"
-        elif self.args['pkg_man'] == "dnf":
-            repo_dest = "/etc/yum.repos.d"
-        else:
-            self.logger.error("unsupported package manager")
+        repo_dest = self.repo_dest
+        if repo_dest is None:
+            if self.args['pkg_man'] == "zypper":
+                repo_dest = "/etc/zypp/repos.d"
+            elif self.args['pkg_man'] == "dnf":
+                repo_dest = "/etc/yum.repos.d"
+            else:
+                self.logger.error("unsupported package manager")
         scap_packages = self._generate_scap_package_list()
         try:
-            self.inst.install_base_packages(scap_packages, repo_dest, self.args['proxy'])
+            if self.args['parent'] == "scratch":
+                self.inst.install_scratch_packages(scap_packages, repo_dest, self.args['proxy'])
+            else:
+                self.inst.install_packages(scap_packages)
         except Exception as e:
             self.logger.error(f"Issues installing openscap with repos available - typically available via distro appstream repo: {e}")
-            cmd(["buildah","rm"] + [cname])
-            sys.exit("Exiting now")
-        except KeyboardInterrupt:
-            self.logger.error(f"Keyboard Interrupt")
-            cmd(["buildah","rm"] + [cname])
-            sys.exit("Exiting now ...")
+            raise
+
+    @traced('oscap.fetch_oval')
+    def fetch_oval(self):
+        """
+        Downloads and decompresses the OVAL definitions on the host, so that
+        this can happen while the image is still being built
+        """
+        dest = os.path.join(self.inst.tdir, "oval.xml")
+        handlers = []
+        if self.args['proxy']:
+            handlers.append(urllib.request.ProxyHandler({'http': self.args['proxy'], 'https': self.args['proxy']}))
+        opener = urllib.request.build_opener(*handlers)
+        self.logger.info(f"OPENSCAP: downloading OVAL definitions from {self.oscap_config['oval_url']}")
+        try:
+            with opener.open(self.oscap_config['oval_url']) as res, open(dest, 'wb') as f:
+                shutil.copyfileobj(bz2.BZ2File(res), f)
+        except Exception as e:
+            self.logger.error(f"Error downloading the OVAL definitions: {e}")
+            raise
+        self.oval_file = dest
 
 
+    @traced('oscap.run_oval_eval')
     def run_oval_eval(self):
         obtain_oval_cmd = self._generate_obtain_oval_cmd()
         evaluation_oval = self._generate_evaluate_oval()
@@ -56,16 +82,19 @@ class Oscap:
             {'cmd': evaluation_oval, 'loglevel': 'DEBUG'}
         ]
         try:
-            self.inst.install_base_commands(commands)
+            if self.oval_file:
+                # Already downloaded by fetch_oval()
+                if self.inst.mname:
+                    shutil.copyfile(self.oval_file, os.path.join(self.inst.mname, self.oscap_config['oval_xml'].lstrip('/')))
+                else:
+                    cmd(["buildah","copy", self.inst.cname, self.oval_file, self.oscap_config['oval_xml']])
+                commands = commands[1:]
+            self.inst.install_commands(commands)
         except Exception as e:
-            self.logger.error("Error with SCAP OVAL eval - Please check the logs: {e}")
-            cmd(["buildah","rm"] + [cname])
-            sys.exit("Exiting now")
-        except KeyboardInterrupt:
-            self.logger.error(f"Keyboard Interrupt")
-            cmd(["buildah","rm"] + [cname])
-            sys.exit("Exiting now ...")
+            self.logger.error(f"Error with SCAP OVAL eval - Please check the logs: {e}")
+            raise
 
+    @traced('oscap.run_oscap')
     def run_oscap(self):
         evaluation_cmd = self._generate_evaluate_cmd()
         remediation_cmd = self._generate_remediate_cmd()
@@ -75,15 +104,10 @@ class Oscap:
             {'cmd': remediation_cmd, 'loglevel': 'DEBUG'}
         ]
         try:
-            self.inst.install_base_commands(commands)
+            self.inst.install_commands(commands)
         except Exception as e:
-            self.logger.error("Error with SCAP benchmark and generation of remediation script - please check the logs: {e}")
-            cmd(["buildah","rm"] + [cname])
-            sys.exit("Exiting now")
-        except KeyboardInterrupt:
-            self.logger.error(f"Keyboard Interrupt")
-            cmd(["buildah","rm"] + [cname])
-            sys.exit("Exiting now ...")
+            self.logger.error(f"Error with SCAP benchmark and generation of remediation script - please check the logs: {e}")
+            raise
 
 
     def _get_oscap_filepaths(self):
@@ -0,0 +1,136 @@
+"""
+Package Cache Module
+
+This module provides a class, PackageCache, that manages a persistent package
+manager cache directory shared by builds. Builds take a shared lock while the
+package manager runs and eviction takes an exclusive lock, so several builds
+can use the same cache directory at once.
+"""
+
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import time
+# written modules
+from utils import parse_size
+
+class PackageCache:
+    def __init__(self, cache_dir, pkg_man, max_size=0, max_age=0):
+        self.root = os.path.expanduser(cache_dir)
+        self.path = os.path.join(self.root, pkg_man)
+        self.max_size = parse_size(max_size)
+        # max_age is given in days
+        self.max_age = float(max_age or 0) * 86400
+        self.hits = 0
+        self.misses = 0
+        self.fetched_bytes = 0
+        self.logger = logging.getLogger(__name__)
+
+        os.makedirs(self.path, exist_ok=True)
+        if os.statvfs(self.path).f_flag & getattr(os, 'ST_NOATIME', 0):
+            self.logger.warn(f"PACKAGE CACHE: {self.path} is mounted with noatime, cache hits are not counted "
+                             "and eviction goes by the time packages were downloaded")
+        self.lock_file = os.path.join(self.root, pkg_man + ".lock")
+        self.index_file = os.path.join(self.root, pkg_man + ".index.json")
+
+    @contextlib.contextmanager
+    def _lock(self, mode):
+        with open(self.lock_file, 'a') as f:
+            fcntl.flock(f, mode)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _snapshot(self):
+        files = {}
+        for root, dirs, fnames in os.walk(self.path):
+            for f in fnames:
+                p = os.path.join(root, f)
+                try:
+                    files[os.path.relpath(p, self.path)] = os.stat(p)
+                except FileNotFoundError:
+                    continue
+        return files
+
+    def _load_index(self):
+        if not os.path.exists(self.index_file):
+            return {}
+        with open(self.index_file, 'r') as f:
+            return json.load(f)
+
+    def _save_index(self, index):
+        with open(self.index_file + ".tmp", 'w') as f:
+            json.dump(index, f)
+        os.replace(self.index_file + ".tmp", self.index_file)
+
+    @contextlib.contextmanager
+    def use(self, exclusive=False):
+        """
+        Wraps one package manager run that reads from and writes to the cache.
+        Files added during the run count as misses, files that were read from
+        the cache count as hits.
+        """
+        with self._lock(fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH):
+            # Nothing resets atimes while the cache is held, so a file whose
+            # atime moved was read during the run
+            before = self._snapshot()
+            try:
+                yield
+            finally:
+                used = []
+                for rel, st in self._snapshot().items():
+                    old = before.get(rel)
+                    if old is None or old.st_ino != st.st_ino or old.st_mtime_ns != st.st_mtime_ns:
+                        self.misses += 1
+                        self.fetched_bytes += st.st_size
+                        used.append((rel, st))
+                    elif st.st_atime_ns > old.st_atime_ns:
+                        self.hits += 1
+                        used.append((rel, st))
+
+        now = time.time()
+        with self._lock(fcntl.LOCK_EX):
+            index = self._load_index()
+            for rel, st in used:
+                index[rel] = now
+                # Reset atime to mtime so that the next read updates it even on
+                # relatime mounts. Only done while no other build holds the cache.
+                with contextlib.suppress(OSError):
+                    os.utime(os.path.join(self.path, rel), ns=(st.st_mtime_ns, st.st_mtime_ns))
+            self._save_index(index)
+
+    def evict(self):
+        """Removes cached files older than max_age, then the least recently used until below max_size"""
+        if not self.max_size and not self.max_age:
+            return
+
+        with self._lock(fcntl.LOCK_EX):
+            index = self._load_index()
+            files = self._snapshot()
+            now = time.time()
+            last_used = {rel: index.get(rel, st.st_mtime) for rel, st in files.items()}
+            total = sum(st.st_size for st in files.values())
+            evicted = 0
+            evicted_bytes = 0
+
+            for rel in sorted(files, key=lambda r: last_used[r]):
+                too_old = self.max_age and now - last_used[rel] > self.max_age
+                too_big = self.max_size and total > self.max_size
+                if not too_old and not too_big:
+                    break
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(os.path.join(self.path, rel))
+                total -= files[rel].st_size
+                evicted += 1
+                evicted_bytes += files[rel].st_size
+                index.pop(rel, None)
+
+            self._save_index({rel: t for rel, t in index.items() if rel in files})
+
+        self.logger.info(f"PACKAGE CACHE: evicted {evicted} files ({evicted_bytes} bytes), {total} bytes remain in {self.path}")
+
+    def report(self):
+        self.logger.info(f"PACKAGE CACHE: {self.hits} hits, {self.misses} misses, {self.fetched_bytes} bytes fetched into {self.path}")
@@ -1,12 +1,28 @@
 import subprocess
 import boto3
+import hashlib
 import os
 import tempfile
+import urllib.parse
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 # local imports
-from utils import cmd, get_os
+from utils import cmd, get_os, parse_size
+from s3_stream import StreamingUpload
+from s3_chunks import chunked_push, MANIFEST_SUFFIX
+from registry import Registry
+from tracing import traced
+from squashfs import squash_args, squash_image, squash_options
 import logging
 
+# Prefix of the kernel and initramfs keys
+BOOT_PREFIX = 'efi-images/'
+# Empty objects named by the sha256 of a kernel or initramfs, pointing at a key
+# with those contents
+BOOT_INDEX_PREFIX = BOOT_PREFIX + '.by-sha256/'
+
 def _generate_labels(args):
     """Generate standard labels from configuration data"""
     labels = {}
@@ -45,7 +61,8 @@ def _generate_labels(args):
     
     return labels
 
-def publish(cname, args):
+@traced('publish.publish')
+def publish(cname, args, cache_ref=None, remove_parent=True):
 
     layer_name = args['name']
     publish_tags = args['publish_tags']
@@ -55,87 +72,291 @@ def publish(cname, args):
         credentials = args['credentials']
     parent = args['parent']
     
+    published = {}
+
     # Generate standard labels
     print("Generating labels")
     labels = _generate_labels(args)
     print("Labels: " + str(labels))
     
+    # Local and registry publishing share a single commit
+    image_name = layer_name+':'+publish_tags[0]
+    image_id = None
+    if args['publish_local'] or args['publish_registry']:
+        image_id = commit_image(cname, image_name, labels)
+
     if args['publish_local']:
         print("Publishing to local storage")
-        for tag in publish_tags:
-            # Add labels if they exist
-            if labels:
-                label_args = []
-                for key, value in labels.items():
-                    label_args.extend(['--label', f'{key}={value}'])
-                cmd(["buildah", "config"] + label_args + [cname], stderr_handler=logging.warn)
-            cmd(["buildah","commit", cname, layer_name+':'+tag], stderr_handler=logging.warn)
+        if len(publish_tags) > 1:
+            cmd(["buildah", "tag", image_id] + [layer_name+':'+tag for tag in publish_tags[1:]], stderr_handler=logging.warn)
 
     if args['publish_s3']:
         s3_prefix = args['s3_prefix']
         s3_bucket = args['s3_bucket']
+        transfer = s3_transfer_config(args)
         print("Publishing to S3 at " + s3_bucket)
-        for tag in publish_tags:
-            s3_push(cname, layer_name, credentials, tag, s3_prefix, s3_bucket)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # Squash and pick the boot files once for all tags
+            stream = args['s3_stream']
+            if stream and args['s3_chunk_prefix']:
+                logging.warn("s3_stream cannot be combined with chunked publishing, squashing to a file first")
+                stream = False
+            artifacts = prepare_s3_artifacts(cname, tmpdir, squash_options(args), squash=not stream)
+            s3_keys = s3_push(artifacts, layer_name, credentials, publish_tags[0], s3_prefix, s3_bucket,
+                              transfer, args['s3_chunk_prefix'])
+        cmd(["buildah", "umount", cname], stderr_handler=logging.warn)
+        # The other tags get a server side copy of the rootfs (or its manifest)
+        # instead of another upload. The kernel and initramfs keys do not
+        # depend on the tag.
+        s3 = _s3_resource(credentials)
+        for tag in publish_tags[1:]:
+            copy_file(s3_keys['rootfs'], s3_bucket, _retag_key(s3_keys['rootfs'], s3_prefix, publish_tags[0], s3_prefix, tag),
+                      s3, s3_bucket, transfer)
+        published['s3'] = {
+            'endpoint_url': credentials['endpoint_url'],
+            'bucket': s3_bucket,
+            'prefix': s3_prefix,
+            'chunk_prefix': args['s3_chunk_prefix'],
+            'tag': publish_tags[0],
+            'keys': s3_keys
+        }
 
     if args['publish_registry']:
         registry_opts = args['registry_opts_push']
         publish_dest = args['publish_registry']
         print("Publishing to registry at " + publish_dest)
-        image_name = layer_name+':'+publish_tags[0]
-        # Add labels if they exist
-        if labels:
-            label_args = []
-            for key, value in labels.items():
-                label_args.extend(['--label', f'{key}={value}'])
-            cmd(["buildah", "config"] + label_args + [cname], stderr_handler=logging.warn)
-        cmd(["buildah", "commit", cname, image_name], stderr_handler=logging.warn)
-        for tag in publish_tags:
-            cmd(["buildah", "tag", image_name, layer_name+':'+tag], stderr_handler=logging.warn)
-            registry_push(layer_name, registry_opts, tag, publish_dest)
+        registry_publish(image_name, layer_name, registry_opts, publish_tags, publish_dest)
+
+    if cache_ref:
+        print("Storing layer in build cache as " + cache_ref)
+        if image_id:
+            cmd(["buildah", "tag", image_id, cache_ref], stderr_handler=logging.warn)
+        else:
+            cmd(["buildah", "commit", cname, cache_ref], stderr_handler=logging.warn)
 
     # Clean up
     cmd(["buildah", "rm", cname], stderr_handler=logging.warn)
+    if not args['publish_local'] and args['publish_registry']:
+        for tag in publish_tags:
+            cmd(["buildah","rmi", layer_name+':'+tag], stderr_handler=logging.warn)
+    # Targets built from the same parent remove it once all of them are published
+    if remove_parent and not parent == "scratch":
+        cmd(["buildah", "rmi", parent], stderr_handler=logging.warn)
+
+    return published
+
+@traced('publish.commit_image')
+def commit_image(cname, image_name, labels):
+    """
+    Applies the labels and commits the container once as image_name
+
+    Returns:
+        str: ID of the committed image
+    """
+    # Add labels if they exist
+    if labels:
+        label_args = []
+        for key, value in labels.items():
+            label_args.extend(['--label', f'{key}={value}'])
+        cmd(["buildah", "config"] + label_args + [cname], stderr_handler=logging.warn)
+
+    def buildah_handler(line):
+        out.append(line)
+    out = []
+    cmd(["buildah", "commit", cname, image_name], stdout_handler=buildah_handler, stderr_handler=logging.warn)
+    # buildah commit prints the image ID last
+    image_id = out[-1]
+    logging.info(f"Committed {cname} as {image_name} ({image_id})")
+    return image_id
+
+@traced('publish.publish_cached')
+def publish_cached(entry, args):
+    """
+    Publishes a layer from the build cache. The cached image is re-tagged for
+    local and registry publishing, and the S3 objects of the cached build are
+    copied server side, so no working container is needed.
+    """
+    image = entry['image']
+    layer_name = args['name']
+    publish_tags = args['publish_tags']
+    if type(publish_tags) is not list:
+        publish_tags = [publish_tags]
+    parent = args['parent']
+
+    if args['publish_local']:
+        print("Publishing cached image " + image + " to local storage")
+        for tag in publish_tags:
+            cmd(["buildah", "tag", image, layer_name+':'+tag], stderr_handler=logging.warn)
+
+    if args['publish_s3']:
+        s3_prefix = args['s3_prefix']
+        s3_bucket = args['s3_bucket']
+        print("Publishing cached image to S3 at " + s3_bucket)
+        transfer = s3_transfer_config(args)
+        s3 = _s3_resource(args['credentials'])
+        cached = entry['s3']
+        for kind, key in cached['keys'].items():
+            if kind == 'rootfs':
+                new_keys = [_retag_key(key, cached['prefix'], cached['tag'], s3_prefix, tag) for tag in publish_tags]
+            else:
+                new_keys = [BOOT_PREFIX + s3_prefix + os.path.basename(key)]
+            for new_key in new_keys:
+                if new_key == key and s3_bucket == cached['bucket']:
+                    print(new_key + " already present in " + s3_bucket)
+                    continue
+                copy_file(key, cached['bucket'], new_key, s3, s3_bucket, transfer)
+
+    if args['publish_registry']:
+        registry_opts = args['registry_opts_push']
+        publish_dest = args['publish_registry']
+        print("Publishing cached image " + image + " to registry at " + publish_dest)
+        cmd(["buildah", "tag", image, layer_name+':'+publish_tags[0]], stderr_handler=logging.warn)
+        registry_publish(layer_name+':'+publish_tags[0], layer_name, registry_opts, publish_tags, publish_dest)
+
+    # Clean up
     if not args['publish_local'] and args['publish_registry']:
         for tag in publish_tags:
             cmd(["buildah","rmi", layer_name+':'+tag], stderr_handler=logging.warn)
     if not parent == "scratch":
         cmd(["buildah", "rmi", parent], stderr_handler=logging.warn)
 
-def push_file(fname, kname, s3, bucket_name):
+def _retag_key(key, prefix, tag, new_prefix, new_tag):
+    """Moves an image key to another prefix and tag, keeping anything after the tag (like a manifest suffix)"""
+    base, _, suffix = key[len(prefix):].rpartition('-' + tag)
+    return new_prefix + base + '-' + new_tag + suffix
+
+def s3_transfer_config(args):
+    """Builds the multipart transfer settings from s3_part_size and s3_concurrency"""
+    part_size = parse_size(args.get('s3_part_size')) or 64 * 1024**2
+    return TransferConfig(multipart_threshold=part_size,
+                          multipart_chunksize=part_size,
+                          max_concurrency=int(args.get('s3_concurrency') or 10))
+
+@traced('publish.push_file')
+def push_file(fname, kname, s3, bucket_name, transfer=None):
     print("Pushing " + fname + " as " + kname + " to " + bucket_name)
 
-    bucket = s3.Bucket(bucket_name)
-    bucket.upload_file(Filename=fname,Key=kname)
+    # The client (unlike the resource) can be shared between threads
+    s3.meta.client.upload_file(Filename=fname, Bucket=bucket_name, Key=kname, Config=transfer)
 
-def squash_image(mname, tmpdir):
-    print("squashing container image")
-    args = ["mksquashfs"]
-    args.append(mname)
-    args.append(tmpdir + "/rootfs")
+@traced('publish.copy_file')
+def copy_file(src_kname, src_bucket, kname, s3, bucket_name, transfer=None, extra_args=None):
+    print("Copying " + src_bucket + "/" + src_kname + " to " + bucket_name + "/" + kname)
 
-    process = subprocess.run(args,
-            stdout=subprocess.PIPE,
-            universal_newlines=True)
-    # if verbose:
-    #     print(process.stdout)
+    # Copies server side, as a multipart copy for large objects
+    s3.meta.client.copy({'Bucket': src_bucket, 'Key': src_kname}, bucket_name, kname, ExtraArgs=extra_args, Config=transfer)
 
-def s3_push(cname, layer_name, credentials, publish_tags, s3_prefix, s3_bucket):
-    def buildah_handler(line):
-            out.append(line)
-    out = []
-    cmd(["buildah", "mount", cname],stdout_handler = buildah_handler)
-    mdir = out[0]
-   
-    print(mdir)
+def _md5(data=b''):
+    """MD5 only serves to predict S3 ETags, which FIPS mode allows when it is not used for security"""
+    try:
+        return hashlib.md5(data, usedforsecurity=False)
+    except TypeError:
+        return hashlib.md5(data)
 
-    # Get s3 resource set
-    s3 = boto3.resource('s3',
+def file_digests(fname, part_size):
+    """
+    Reads fname once for its sha256 and the ETags S3 gives it when uploaded in
+    one piece or in parts of part_size
+
+    Returns:
+        dict: 'sha256', the possible 'etags' and the 'size' of the file
+    """
+    sha256 = hashlib.sha256()
+    md5 = _md5()
+    parts = []
+    size = 0
+    with open(fname, 'rb') as f:
+        while True:
+            chunk = f.read(part_size)
+            if not chunk:
+                break
+            sha256.update(chunk)
+            md5.update(chunk)
+            parts.append(_md5(chunk).digest())
+            size += len(chunk)
+    multipart = _md5(b''.join(parts)).hexdigest() + '-' + str(len(parts))
+    return {'sha256': sha256.hexdigest(), 'etags': {md5.hexdigest(), multipart}, 'size': size}
+
+def _head(client, bucket_name, kname):
+    try:
+        return client.head_object(Bucket=bucket_name, Key=kname)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return None
+        raise
+
+def _same_contents(head, digests):
+    """Whether the object of a HEAD response has the contents digests describes"""
+    if head['ContentLength'] != digests['size']:
+        return False
+    if 'sha256' in head['Metadata']:
+        return head['Metadata']['sha256'] == digests['sha256']
+    # Objects uploaded before the hash was recorded
+    return head['ETag'].strip('"') in digests['etags']
+
+def _find_identical(client, bucket_name, kname, digests):
+    """Returns the key the index records for the sha256 in digests, if it still has those contents"""
+    index = _head(client, bucket_name, BOOT_INDEX_PREFIX + digests['sha256'])
+    if not index or 'key' not in index['Metadata']:
+        return None
+    src_kname = urllib.parse.unquote(index['Metadata']['key'])
+    if src_kname == kname:
+        return None
+    # The object may have been replaced or removed since it was indexed
+    head = _head(client, bucket_name, src_kname)
+    if head and _same_contents(head, digests):
+        return src_kname
+    return None
+
+def _index_boot_file(client, bucket_name, kname, digests):
+    """Records kname as an object with the contents digests describes"""
+    client.put_object(Bucket=bucket_name, Key=BOOT_INDEX_PREFIX + digests['sha256'], Body=b'',
+                      Metadata={'key': urllib.parse.quote(kname)})
+
+@traced('publish.push_boot_file')
+def push_boot_file(fname, kname, s3, bucket_name, transfer=None):
+    """
+    Uploads a kernel or initramfs, unless the bucket already has the same
+    contents. An object at kname with the same sha256 is kept, and the object
+    the sha256 index points at is copied server side. The sha256 is stored in
+    the object metadata for the next check, and uploads are added to the index.
+    """
+    client = s3.meta.client
+    digests = file_digests(fname, transfer.multipart_chunksize if transfer else TransferConfig().multipart_chunksize)
+    metadata = {'Metadata': {'sha256': digests['sha256']}}
+
+    head = _head(client, bucket_name, kname)
+    if head and _same_contents(head, digests):
+        print(kname + " already present in " + bucket_name)
+        if head['Metadata'].get('sha256') != digests['sha256']:
+            # Only the ETag matched, record the hash
+            copy_file(kname, bucket_name, kname, s3, bucket_name, transfer, dict(metadata, MetadataDirective='REPLACE'))
+            _index_boot_file(client, bucket_name, kname, digests)
+        return
+
+    src_kname = _find_identical(client, bucket_name, kname, digests)
+    if src_kname:
+        copy_file(src_kname, bucket_name, kname, s3, bucket_name, transfer, dict(metadata, MetadataDirective='REPLACE'))
+        return
+
+    print("Pushing " + fname + " as " + kname + " to " + bucket_name)
+    client.upload_file(Filename=fname, Bucket=bucket_name, Key=kname, ExtraArgs=metadata, Config=transfer)
+    _index_boot_file(client, bucket_name, kname, digests)
+
+def _s3_resource(credentials):
+    return boto3.resource('s3',
                     endpoint_url=credentials['endpoint_url'],
                     aws_access_key_id=credentials['access_key'],
                     aws_secret_access_key=credentials['secret_key'],
                     verify=False, use_ssl=False)
 
+def find_boot_files(mdir):
+    """
+    Picks the kernel and initramfs to publish from the mounted rootfs
+
+    Returns:
+        tuple: (vmlinuz, initrd) file names in /boot
+    """
     # Set initrd to be blank to act as sentinel in case no intrds are found
     initrd = ''
 
@@ -165,18 +386,133 @@ def s3_push(cname, layer_name, credentials, publish_tags, s3_prefix, s3_bucket):
     if initrd == '':
         raise Exception('No initramfs or initrd found in /boot for any of the available kernel versions')
 
-    with tempfile.TemporaryDirectory() as tmpdir:
-        squash_image(mdir, tmpdir)
-        image_name = s3_prefix+get_os(mdir)+'-'+layer_name+'-'+publish_tags
-        print("Image Name: " + image_name)
-        print("initramfs: " + initrd )
-        print("vmlinuz: " + vmlinuz )
-        push_file(mdir+'/boot/'+initrd, 'efi-images/' + s3_prefix + initrd, s3, s3_bucket)
-        push_file(mdir+'/boot/'+vmlinuz, 'efi-images/' + s3_prefix + vmlinuz, s3, s3_bucket)
-        push_file(tmpdir + '/rootfs', image_name, s3, s3_bucket)
-
-def registry_push(layer_name, registry_opts, publish_tags, registry_endpoint):
+    return vmlinuz, initrd
+
+@traced('publish.prepare_s3_artifacts')
+def prepare_s3_artifacts(cname, tmpdir, squash_opts, squash=True):
+    """
+    Mounts the container, picks the kernel and initramfs and squashes the
+    rootfs into tmpdir. This is done once per build; every publish tag
+    reuses the result. Without squash, the rootfs is left to be squashed
+    while it is uploaded.
+
+    Returns:
+        dict: paths of the 'vmlinuz', 'initrd' and 'rootfs' artifacts and the 'os' name
+    """
+    def buildah_handler(line):
+            out.append(line)
+    out = []
+    cmd(["buildah", "mount", cname],stdout_handler = buildah_handler)
+    mdir = out[0]
+
+    print(mdir)
+
+    vmlinuz, initrd = find_boot_files(mdir)
+    print("initramfs: " + initrd )
+    print("vmlinuz: " + vmlinuz )
+
+    if squash:
+        squash_image(mdir, tmpdir + '/rootfs', squash_opts)
+
+    return {
+        'mdir': mdir,
+        'tmpdir': tmpdir,
+        'streamed': not squash,
+        # Streaming uploads parts behind the write position, which mksquashfs
+        # only leaves alone without duplicate detection
+        'squash_args': squash_args(mdir, tmpdir + '/rootfs', dict(squash_opts or {}, no_duplicates=True)),
+        'os': get_os(mdir),
+        'initrd': mdir+'/boot/'+initrd,
+        'vmlinuz': mdir+'/boot/'+vmlinuz,
+        'rootfs': tmpdir + '/rootfs'
+    }
+
+@traced('publish.stream_squash')
+def stream_squash(artifacts, kname, s3, bucket_name, transfer):
+    """Squashes the rootfs while uploading it, keeping at most max_concurrency parts in memory"""
+    print("squashing and streaming container image")
+    upload = StreamingUpload(s3.meta.client, bucket_name, kname,
+                             transfer.multipart_chunksize, transfer.max_request_concurrency)
+    upload.run(artifacts['squash_args'], artifacts['rootfs'])
+
+@traced('publish.s3_push')
+def s3_push(artifacts, layer_name, credentials, publish_tags, s3_prefix, s3_bucket, transfer=None, chunk_prefix=None):
+    # Get s3 resource set
+    s3 = _s3_resource(credentials)
+
+    image_name = s3_prefix+artifacts['os']+'-'+layer_name+'-'+publish_tags
+    print("Image Name: " + image_name)
+    keys = {
+        'initrd': BOOT_PREFIX + s3_prefix + os.path.basename(artifacts['initrd']),
+        'vmlinuz': BOOT_PREFIX + s3_prefix + os.path.basename(artifacts['vmlinuz']),
+        'rootfs': image_name + (MANIFEST_SUFFIX if chunk_prefix else '')
+    }
+
+    # Upload all three artifacts at once
+    with ThreadPoolExecutor(len(keys)) as pool:
+        futures = []
+        for kind, kname in keys.items():
+            if kind == 'rootfs' and chunk_prefix:
+                futures.append(pool.submit(chunked_push, artifacts['rootfs'], image_name, s3.meta.client, s3_bucket,
+                                           chunk_prefix, transfer.max_request_concurrency))
+            elif kind == 'rootfs' and artifacts['streamed']:
+                futures.append(pool.submit(stream_squash, artifacts, kname, s3, s3_bucket, transfer))
+            elif kind == 'rootfs':
+                futures.append(pool.submit(push_file, artifacts[kind], kname, s3, s3_bucket, transfer))
+            else:
+                # Only the kernel and initramfs are shared between images
+                futures.append(pool.submit(push_boot_file, artifacts[kind], kname, s3, s3_bucket, transfer))
+        for f in futures:
+            f.result()
+
+    return keys
+
+@traced('publish.registry_push')
+def registry_push(layer_name, registry_opts, publish_tags, registry_endpoint, digestfile=None):
     image_name = layer_name+':'+publish_tags
     print("pushing layer " + layer_name + " to " + registry_endpoint +'/'+image_name)
     args = registry_opts + [image_name, registry_endpoint +'/'+image_name]
+    if digestfile:
+        args = ["--digestfile", digestfile] + args
     cmd(["buildah", "push"] + args, stderr_handler=logging.warn)
+
+@traced('publish.registry_alias')
+def registry_alias(layer_name, registry_opts, digest, tag, registry_endpoint):
+    """
+    Points tag at the already pushed manifest digest. Tags that already point
+    at it are skipped, and tags that do not are set with a manifest-only PUT.
+    Falls back to a full push if the registry API cannot be used.
+    """
+    image_name = layer_name+':'+tag
+    try:
+        registry = Registry(registry_endpoint, registry_opts)
+        if registry.manifest_digest(layer_name, tag) == digest:
+            print(registry_endpoint +'/'+image_name + " is already at " + digest)
+            return
+        print("tagging " + registry_endpoint +'/'+image_name + " as " + digest)
+        registry.tag(layer_name, digest, tag)
+    except Exception as e:
+        logging.warn(f"could not tag {image_name} through the registry API ({e}), pushing it instead")
+        registry_push(layer_name, registry_opts, tag, registry_endpoint)
+
+@traced('publish.registry_publish')
+def registry_publish(image_name, layer_name, registry_opts, publish_tags, registry_endpoint):
+    """
+    Pushes the image once for the first tag, then points the other tags at
+    the pushed manifest concurrently.
+    """
+    cmd(["buildah", "tag", image_name] + [layer_name+':'+tag for tag in publish_tags], stderr_handler=logging.warn)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        digestfile = os.path.join(tmpdir, "digest")
+        registry_push(layer_name, registry_opts, publish_tags[0], registry_endpoint, digestfile)
+        with open(digestfile, 'r') as f:
+            digest = f.read().strip()
+
+    if len(publish_tags) < 2:
+        return
+    with ThreadPoolExecutor(len(publish_tags) - 1) as pool:
+        futures = [pool.submit(registry_alias, layer_name, registry_opts, digest, tag, registry_endpoint)
+                   for tag in publish_tags[1:]]
+        for f in futures:
+            f.result()
@@ -0,0 +1,118 @@
+"""
+Registry Module
+
+This module provides a class, Registry, that talks to an OCI registry over the
+distribution API to look up manifest digests and to tag an already pushed
+manifest under more tags without pushing the image again. Credentials and TLS
+settings are taken from the same options that are passed to `buildah push`.
+"""
+
+import base64
+import json
+import logging
+import os
+import re
+import requests
+
+MANIFEST_TYPES = [
+    'application/vnd.oci.image.manifest.v1+json',
+    'application/vnd.oci.image.index.v1+json',
+    'application/vnd.docker.distribution.manifest.v2+json',
+    'application/vnd.docker.distribution.manifest.list.v2+json',
+]
+
+def _opt_value(opts, name):
+    """Returns the value of option name (as '--name value' or '--name=value') in opts"""
+    for i, o in enumerate(opts):
+        if o == name and i + 1 < len(opts):
+            return opts[i + 1]
+        if o.startswith(name + '='):
+            return o.split('=', 1)[1]
+    return None
+
+class Registry:
+    def __init__(self, endpoint, registry_opts):
+        # endpoint is the publish_registry value, e.g. registry.mysite.tld/openchami
+        self.host, _, self.namespace = endpoint.partition('/')
+        self.verify = (_opt_value(registry_opts, '--tls-verify') or 'true').lower() != 'false'
+        self.creds = self._find_creds(registry_opts)
+        self.session = requests.Session()
+        self.scheme = 'https'
+        self.token = None
+        self.logger = logging.getLogger(__name__)
+
+    def _find_creds(self, registry_opts):
+        creds = _opt_value(registry_opts, '--creds')
+        if creds:
+            return tuple(creds.split(':', 1))
+
+        authfiles = [
+            _opt_value(registry_opts, '--authfile'),
+            os.getenv('REGISTRY_AUTH_FILE'),
+            os.path.join(os.getenv('XDG_RUNTIME_DIR', '/run/user/' + str(os.getuid())), 'containers/auth.json'),
+            os.path.expanduser('~/.config/containers/auth.json'),
+            os.path.expanduser('~/.docker/config.json'),
+        ]
+        for authfile in authfiles:
+            if not authfile or not os.path.exists(authfile):
+                continue
+            with open(authfile, 'r') as f:
+                auths = json.load(f).get('auths', {})
+            for key in (self.host, 'https://' + self.host, 'http://' + self.host):
+                if key in auths and 'auth' in auths[key]:
+                    return tuple(base64.b64decode(auths[key]['auth']).decode().split(':', 1))
+        return None
+
+    def _authenticate(self, challenge):
+        scheme, _, params = challenge.partition(' ')
+        if scheme.lower() == 'basic':
+            self.session.auth = self.creds
+            return
+        params = dict(re.findall(r'(\w+)="([^"]*)"', params))
+        realm = params.pop('realm')
+        res = self.session.get(realm, params=params, auth=self.creds, verify=self.verify)
+        res.raise_for_status()
+        body = res.json()
+        self.token = body.get('token') or body.get('access_token')
+
+    def _request(self, method, path, **kwargs):
+        headers = kwargs.pop('headers', {})
+        for attempt in range(2):
+            if self.token:
+                headers['Authorization'] = 'Bearer ' + self.token
+            try:
+                res = self.session.request(method, f"{self.scheme}://{self.host}/v2/{path}",
+                                           headers=headers, verify=self.verify, **kwargs)
+            except requests.exceptions.SSLError:
+                if self.verify:
+                    raise
+                # --tls-verify=false also allows plain HTTP registries
+                self.scheme = 'http'
+                res = self.session.request(method, f"{self.scheme}://{self.host}/v2/{path}",
+                                           headers=headers, **kwargs)
+            if res.status_code == 401 and attempt == 0 and 'WWW-Authenticate' in res.headers:
+                self._authenticate(res.headers['WWW-Authenticate'])
+                continue
+            return res
+        return res
+
+    def repository(self, name):
+        return self.namespace + '/' + name if self.namespace else name
+
+    def manifest_digest(self, name, reference):
+        """Returns the digest of the manifest for name:reference, or None if it does not exist"""
+        res = self._request('HEAD', f"{self.repository(name)}/manifests/{reference}",
+                            headers={'Accept': ', '.join(MANIFEST_TYPES)})
+        if res.status_code == 404:
+            return None
+        res.raise_for_status()
+        return res.headers.get('Docker-Content-Digest')
+
+    def tag(self, name, digest, tag):
+        """Tags the manifest with the given digest as name:tag, without touching any blobs"""
+        res = self._request('GET', f"{self.repository(name)}/manifests/{digest}",
+                            headers={'Accept': ', '.join(MANIFEST_TYPES)})
+        res.raise_for_status()
+        res = self._request('PUT', f"{self.repository(name)}/manifests/{tag}", data=res.content,
+                            headers={'Content-Type': res.headers['Content-Type']})
+        res.raise_for_status()
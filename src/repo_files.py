@@ -0,0 +1,99 @@
+"""
+Repo Files Module
+
+This module writes the repos of a config directly as dnf .repo files or
+zypper repo files, instead of registering every repo with the package
+manager, which has to start up for each repo.
+"""
+
+import logging
+import os
+import re
+import urllib.parse
+import urllib.request
+
+def repo_id(r):
+    """Returns the repo id (and file name) for repo r, based on its alias"""
+    return re.sub(r'[^\w.:-]', '_', r['alias'])
+
+def _fetch(url, proxy):
+    handlers = []
+    if proxy:
+        handlers.append(urllib.request.ProxyHandler({'http': proxy, 'https': proxy}))
+    with urllib.request.build_opener(*handlers).open(url) as res:
+        return res.read().decode()
+
+def _add_to_sections(contents, lines):
+    """Adds lines to every section of a downloaded .repo file"""
+    if not lines:
+        return contents
+    return re.sub(r'^(\[[^\]]+\][ \t]*)$', lambda m: m.group(1) + '\n' + '\n'.join(lines),
+                  contents, flags=re.MULTILINE)
+
+def _zypper_proxy_url(url, proxy):
+    # zypper takes the proxy of a repo as URL parameters
+    p = urllib.parse.urlsplit(proxy if '://' in proxy else 'http://' + proxy)
+    params = {'proxy': p.hostname}
+    if p.port:
+        params['proxyport'] = p.port
+    if p.username:
+        params['proxyuser'] = p.username
+        params['proxypass'] = p.password or ''
+    sep = '&' if urllib.parse.urlsplit(url).query else '?'
+    return url + sep + urllib.parse.urlencode(params)
+
+def repo_file(r, pkg_man, proxy="", keep_packages=False):
+    """
+    Generates the repo file for repo r
+
+    Returns:
+        tuple: file name and file contents
+    """
+    name = repo_id(r) + ".repo"
+    if r['url'].endswith('.repo'):
+        # A repo file to use as is, apart from the options we set
+        contents = _fetch(r['url'], proxy)
+        extra = []
+        if proxy and pkg_man == "dnf":
+            extra.append("proxy=" + proxy)
+        if keep_packages and pkg_man == "zypper":
+            extra.append("keeppackages=1")
+        return name, _add_to_sections(contents, extra)
+
+    lines = [f"[{repo_id(r)}]", f"name={r['alias']}", "enabled=1"]
+    if pkg_man == "zypper":
+        url = _zypper_proxy_url(r['url'], proxy) if proxy else r['url']
+        lines += [
+            "autorefresh=1",
+            f"baseurl={url}",
+            f"priority={r.get('priority', 99)}",
+            f"keeppackages={1 if keep_packages else 0}",
+        ]
+    elif pkg_man == "dnf":
+        lines.append(f"baseurl={r['url']}")
+        if 'priority' in r:
+            lines.append(f"priority={r['priority']}")
+        if proxy:
+            lines.append("proxy=" + proxy)
+    else:
+        raise ValueError(f"unsupported package manager {pkg_man}")
+    if "gpg" in r:
+        lines.append(f"gpgkey={r['gpg']}")
+    return name, "\n".join(lines) + "\n"
+
+def write_repo_files(repos, dest, pkg_man, proxy="", keep_packages=False):
+    """Writes the repo files for all repos into dest"""
+    os.makedirs(dest, exist_ok=True)
+    for r in repos:
+        logging.info(r['alias'] + ': ' + r['url'])
+        name, contents = repo_file(r, pkg_man, proxy, keep_packages)
+        with open(os.path.join(dest, name), 'w') as f:
+            f.write(contents)
+
+def gpg_keys(repos):
+    """Returns the gpg keys of all repos, without duplicates"""
+    keys = []
+    for r in repos:
+        if "gpg" in r and r['gpg'] not in keys:
+            keys.append(r['gpg'])
+    return keys
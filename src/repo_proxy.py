@@ -0,0 +1,361 @@
+"""
+Repo Proxy Module
+
+This module provides a class, RepoProxy, a small caching HTTP proxy for
+package repositories. Packages and repodata files are kept in a cache
+directory, which any number of proxies (and so concurrent builds on the same
+host) can share, and the cache is kept below a maximum size by evicting the
+least recently used files.
+
+Files whose contents never change under the same URL (packages, and repodata
+files named after their checksum) are served from the cache without asking the
+upstream server. All other files, such as repomd.xml, are revalidated with a
+conditional request every time, and the cached copy is used when it has not
+changed or when the upstream server cannot be reached.
+
+HTTPS requests are tunneled to the upstream server and cannot be cached, so
+repos have to use http:// URLs to benefit from the cache. Packages are still
+verified by their repo metadata and gpg signatures.
+"""
+
+import contextlib
+import errno
+import fcntl
+import hashlib
+import http.server
+import json
+import logging
+import os
+import re
+import select
+import shutil
+import socket
+import tempfile
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+# written modules
+from utils import parse_size
+
+CHUNK_SIZE = 256 * 1024
+IMMUTABLE_SUFFIXES = ('.rpm', '.drpm', '.srpm')
+# repodata files like 0123abcd...-primary.xml.gz
+HASHED_REPODATA = re.compile(r'/repodata/[0-9a-f]{32,}-[^/]+$')
+# Hop-by-hop headers, which are not passed on
+HOP_HEADERS = {'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+               'proxy-connection', 'te', 'trailers', 'transfer-encoding', 'upgrade'}
+
+def is_immutable(url):
+    path = urllib.parse.urlsplit(url).path
+    return path.endswith(IMMUTABLE_SUFFIXES) or bool(HASHED_REPODATA.search(path))
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        self.server.proxy.logger.debug("REPO PROXY: " + format % args)
+
+    def do_GET(self):
+        self.server.proxy.handle_get(self, head=False)
+
+    def do_HEAD(self):
+        self.server.proxy.handle_get(self, head=True)
+
+    def do_CONNECT(self):
+        self.server.proxy.handle_connect(self)
+
+class _Server(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+class RepoProxy:
+    def __init__(self, cache_dir, max_size=0, upstream_proxy="", host="127.0.0.1", port=0):
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.max_size = parse_size(max_size)
+        self.upstream_proxy = upstream_proxy
+        os.makedirs(os.path.join(self.cache_dir, "objects"), exist_ok=True)
+        self.logger = logging.getLogger(__name__)
+
+        handlers = []
+        if upstream_proxy:
+            handlers.append(urllib.request.ProxyHandler({'http': upstream_proxy, 'https': upstream_proxy}))
+        else:
+            # Do not pick up a proxy from the environment, which may well be us
+            handlers.append(urllib.request.ProxyHandler({}))
+        self.opener = urllib.request.build_opener(*handlers)
+
+        self.server = _Server((host, port), _Handler)
+        self.server.proxy = self
+        self.thread = None
+
+        self.lock = threading.Lock()
+        # One download or revalidation at a time per URL, later requests wait
+        # for it and use the cache. Entries are [lock, number of users].
+        self.url_locks = {}
+        self.stats = {'hits': 0, 'misses': 0, 'revalidated': 0, 'stale': 0, 'tunneled': 0,
+                      'hit_bytes': 0, 'miss_bytes': 0}
+        self.size = self._scan()[1]
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        """Serves requests from a background thread"""
+        self.thread = threading.Thread(target=self.server.serve_forever, name="repo-proxy", daemon=True)
+        self.thread.start()
+        self.logger.info(f"REPO PROXY: caching repos in {self.cache_dir}, listening on {self.url}")
+
+    def serve_forever(self):
+        self.logger.info(f"REPO PROXY: caching repos in {self.cache_dir}, listening on {self.url}")
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.report()
+
+    def report(self):
+        s = self.stats
+        self.logger.info(f"REPO PROXY: {s['hits']} hits ({s['hit_bytes'] / 1024**2:.1f} MiB), "
+                         f"{s['misses']} misses ({s['miss_bytes'] / 1024**2:.1f} MiB), "
+                         f"{s['revalidated']} revalidated, {s['stale']} served stale, "
+                         f"{s['tunneled']} tunneled")
+
+    def _count(self, key, n=1):
+        with self.lock:
+            self.stats[key] += n
+
+    def _paths(self, url):
+        h = hashlib.sha256(url.encode()).hexdigest()
+        base = os.path.join(self.cache_dir, "objects", h[:2], h)
+        return base, base + ".json"
+
+    @contextlib.contextmanager
+    def _url_lock(self, url):
+        with self.lock:
+            entry = self.url_locks.setdefault(url, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self.url_locks[url]
+
+    def _load(self, url):
+        data_path, meta_path = self._paths(url)
+        try:
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if meta.get('url') != url or not os.path.exists(data_path):
+            return None
+        return meta
+
+    def handle_get(self, handler, head):
+        url = handler.path
+        if not url.startswith("http://"):
+            handler.send_error(400, "only absolute http:// URLs can be proxied")
+            return
+        meta = self._load(url)
+        if not (meta and is_immutable(url)):
+            with self._url_lock(url):
+                # Another request may have fetched it in the meantime
+                meta = self._load(url)
+                if not (meta and is_immutable(url)):
+                    meta = self._fetch(handler, url, meta, head)
+                    if meta is None:
+                        return
+        else:
+            self._count('hits')
+        # Cached files are sent without holding the lock, so that any number
+        # of clients can read them at once
+        self._send_cached(handler, url, meta, head)
+
+    def _send_cached(self, handler, url, meta, head):
+        data_path, _ = self._paths(url)
+        try:
+            # Keep track of use for the eviction
+            os.utime(data_path)
+            f = open(data_path, 'rb')
+        except OSError:
+            # Evicted by another proxy in the meantime
+            with self._url_lock(url):
+                self._fetch(handler, url, None, head)
+            return
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            handler.send_response(200)
+            for k, v in meta['headers'].items():
+                handler.send_header(k, v)
+            handler.send_header('Content-Length', str(size))
+            handler.send_header('X-Cache', 'HIT')
+            handler.end_headers()
+            if not head:
+                shutil.copyfileobj(f, handler.wfile, CHUNK_SIZE)
+                self._count('hit_bytes', size)
+
+    def _fetch(self, handler, url, meta, head):
+        """
+        Fetches url, or revalidates the cached copy described by meta
+
+        Returns:
+            dict: meta of the cached copy to send, or None if the response was already sent
+        """
+        req = urllib.request.Request(url, method='HEAD' if head else 'GET')
+        if meta:
+            if meta['headers'].get('ETag'):
+                req.add_header('If-None-Match', meta['headers']['ETag'])
+            if meta['headers'].get('Last-Modified'):
+                req.add_header('If-Modified-Since', meta['headers']['Last-Modified'])
+        try:
+            res = self.opener.open(req, timeout=60)
+        except urllib.error.HTTPError as e:
+            if e.code == 304 and meta:
+                self._count('revalidated')
+                self._count('hits')
+                return meta
+            handler.send_error(e.code, e.reason)
+            return None
+        except (urllib.error.URLError, OSError) as e:
+            if meta:
+                self.logger.warning(f"REPO PROXY: {url} could not be revalidated, using the cached copy: {e}")
+                self._count('stale')
+                return meta
+            handler.send_error(502, str(e))
+            return None
+
+        with res:
+            headers = {k: v for k, v in res.headers.items()
+                       if k.lower() not in HOP_HEADERS and k.lower() != 'content-length'}
+            handler.send_response(200)
+            for k, v in headers.items():
+                handler.send_header(k, v)
+            length = res.headers.get('Content-Length')
+            if length is not None:
+                handler.send_header('Content-Length', length)
+            else:
+                handler.send_header('Connection', 'close')
+                handler.close_connection = True
+            handler.send_header('X-Cache', 'MISS')
+            handler.end_headers()
+            if head:
+                return None
+            self._count('misses')
+            self._stream_and_store(res, handler, url, headers)
+        return None
+
+    def _stream_and_store(self, res, handler, url, headers):
+        """Sends the response to the client and writes it to the cache at the same time"""
+        data_path, meta_path = self._paths(url)
+        os.makedirs(os.path.dirname(data_path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(data_path), prefix=".tmp-")
+        size = 0
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                while True:
+                    chunk = res.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    size += len(chunk)
+                    handler.wfile.write(chunk)
+            expected = res.headers.get('Content-Length')
+            if expected is not None and int(expected) != size:
+                raise IOError(f"short read from {url}")
+            with open(meta_path + ".tmp", 'w') as f:
+                json.dump({'url': url, 'headers': headers}, f)
+            os.replace(tmp, data_path)
+            os.replace(meta_path + ".tmp", meta_path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        self._count('miss_bytes', size)
+        with self.lock:
+            self.size += size
+            over = self.max_size and self.size > self.max_size
+        if over:
+            self.evict()
+
+    def _scan(self):
+        """Returns the cached files with their last use and size, and the total size"""
+        entries = []
+        total = 0
+        for root, dirs, files in os.walk(os.path.join(self.cache_dir, "objects")):
+            for name in files:
+                if name.endswith(".json") or name.startswith(".tmp-"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        return entries, total
+
+    def evict(self):
+        """Removes the least recently used files until the cache is below max_size"""
+        with open(os.path.join(self.cache_dir, ".lock"), 'w') as lock:
+            # Proxies sharing the cache directory take turns evicting
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            entries, total = self._scan()
+            removed = 0
+            for _, size, path in sorted(entries):
+                if total <= self.max_size:
+                    break
+                for p in (path, path + ".json"):
+                    try:
+                        os.unlink(p)
+                    except FileNotFoundError:
+                        pass
+                total -= size
+                removed += 1
+            with self.lock:
+                self.size = total
+        if removed:
+            self.logger.info(f"REPO PROXY: evicted {removed} files, cache is now {total / 1024**2:.1f} MiB")
+
+    def handle_connect(self, handler):
+        """Tunnels a TLS connection to the upstream server, without caching"""
+        self._count('tunneled')
+        try:
+            if self.upstream_proxy:
+                p = urllib.parse.urlsplit(self.upstream_proxy if '://' in self.upstream_proxy
+                                          else 'http://' + self.upstream_proxy)
+                upstream = socket.create_connection((p.hostname, p.port or 80), timeout=60)
+                upstream.sendall(f"CONNECT {handler.path} HTTP/1.1\r\nHost: {handler.path}\r\n\r\n".encode())
+                reply = b''
+                while b'\r\n\r\n' not in reply:
+                    data = upstream.recv(4096)
+                    if not data:
+                        raise OSError(errno.ECONNRESET, "upstream proxy closed the connection")
+                    reply += data
+                if reply.split()[1] != b'200':
+                    raise OSError(errno.ECONNREFUSED, reply.split(b'\r\n')[0].decode())
+            else:
+                host, _, port = handler.path.rpartition(':')
+                upstream = socket.create_connection((host, int(port)), timeout=60)
+        except (OSError, ValueError, IndexError) as e:
+            handler.send_error(502, str(e))
+            return
+        handler.send_response(200, 'Connection Established')
+        handler.end_headers()
+        handler.close_connection = True
+        client = handler.connection
+        with upstream:
+            sockets = [client, upstream]
+            while True:
+                readable, _, errored = select.select(sockets, [], sockets, 60)
+                if errored or not readable:
+                    break
+                for s in readable:
+                    data = s.recv(CHUNK_SIZE)
+                    if not data:
+                        return
+                    (upstream if s is client else client).sendall(data)
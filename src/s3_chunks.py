@@ -0,0 +1,141 @@
+"""
+S3 Chunks Module
+
+This module publishes an image to S3 as content-defined chunks stored by their
+sha256 under a shared chunk prefix, plus a small JSON manifest per image. Only
+chunks missing from the bucket get uploaded, so a new build of an image that
+changed a little uploads little. reassemble() rebuilds the image from its
+manifest.
+
+Chunk boundaries are anchored at a two-byte marker that is found with
+mmap.find, and a marker is only used if the crc32 of the bytes before it
+matches a mask. Boundaries therefore only depend on the nearby content and
+line up again after inserted or removed data, while the scan runs at C speed.
+"""
+
+import hashlib
+import json
+import logging
+import mmap
+import os
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+MANIFEST_SUFFIX = ".manifest.json"
+MANIFEST_VERSION = 1
+
+ANCHOR = b'\x5a\xa5'
+WINDOW = 64
+MIN_CHUNK = 256 * 1024
+MAX_CHUNK = 8 * 1024 * 1024
+# In random data the anchor shows up every 64 KiB, 1 in 16 of them is used,
+# which gives chunks of about 1 MiB on top of the minimum size.
+MASK = 0xF
+
+def chunk_boundaries(data, min_size=MIN_CHUNK, max_size=MAX_CHUNK, mask=MASK):
+    """Yields (start, end) offsets of the content-defined chunks of data"""
+    start = 0
+    size = len(data)
+    while start < size:
+        end = min(start + max_size, size)
+        cut = end
+        pos = start + min_size
+        while pos < end:
+            i = data.find(ANCHOR, pos, end)
+            if i < 0:
+                break
+            if zlib.crc32(data[i - WINDOW:i]) & mask == 0:
+                cut = i
+                break
+            pos = i + 1
+        yield start, cut
+        start = cut
+
+def _existing_chunks(client, bucket, chunk_prefix):
+    existing = set()
+    paginator = client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=chunk_prefix):
+        for obj in page.get('Contents', []):
+            existing.add(obj['Key'][len(chunk_prefix):])
+    return existing
+
+def chunked_push(fname, kname, client, bucket, chunk_prefix, concurrency=10):
+    """
+    Uploads fname as chunks under chunk_prefix and a manifest as kname + MANIFEST_SUFFIX
+
+    Returns:
+        str: key of the manifest
+    """
+    print("Pushing " + fname + " as chunks under " + chunk_prefix + " to " + bucket)
+    existing = _existing_chunks(client, bucket, chunk_prefix)
+    slots = threading.Semaphore(concurrency * 2)
+    chunks = []
+    uploaded = 0
+    uploaded_bytes = 0
+    whole = hashlib.sha256()
+
+    def put(key, body):
+        try:
+            client.put_object(Bucket=bucket, Key=key, Body=body)
+        finally:
+            slots.release()
+
+    with open(fname, 'rb') as f, ThreadPoolExecutor(concurrency) as pool:
+        size = os.fstat(f.fileno()).st_size
+        futures = []
+        if size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                for start, end in chunk_boundaries(data):
+                    body = data[start:end]
+                    whole.update(body)
+                    digest = hashlib.sha256(body).hexdigest()
+                    chunks.append([digest, end - start])
+                    if digest in existing:
+                        continue
+                    existing.add(digest)
+                    uploaded += 1
+                    uploaded_bytes += end - start
+                    slots.acquire()
+                    futures.append(pool.submit(put, chunk_prefix + digest, body))
+        for fut in futures:
+            fut.result()
+
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'size': size,
+        'sha256': whole.hexdigest(),
+        'chunk_prefix': chunk_prefix,
+        'chunks': chunks,
+    }
+    manifest_key = kname + MANIFEST_SUFFIX
+    client.put_object(Bucket=bucket, Key=manifest_key, Body=json.dumps(manifest).encode(),
+                      ContentType='application/json')
+    logging.info(f"uploaded {uploaded} of {len(chunks)} chunks ({uploaded_bytes} of {size} bytes) for {manifest_key}")
+    return manifest_key
+
+def reassemble(client, bucket, manifest_key, output, concurrency=10):
+    """Rebuilds the image described by the manifest into the file output"""
+    manifest = json.loads(client.get_object(Bucket=bucket, Key=manifest_key)['Body'].read())
+    if manifest.get('version') != MANIFEST_VERSION:
+        raise Exception(f"unsupported manifest version {manifest.get('version')} in {manifest_key}")
+
+    def fetch(chunk):
+        digest, size = chunk
+        body = client.get_object(Bucket=bucket, Key=manifest['chunk_prefix'] + digest)['Body'].read()
+        if len(body) != size or hashlib.sha256(body).hexdigest() != digest:
+            raise Exception(f"chunk {digest} of {manifest_key} is corrupt")
+        return body
+
+    whole = hashlib.sha256()
+    chunks = manifest['chunks']
+    with open(output, 'wb') as f, ThreadPoolExecutor(concurrency) as pool:
+        # Fetch a window of chunks at a time so memory use stays bounded
+        for i in range(0, len(chunks), concurrency * 2):
+            for body in pool.map(fetch, chunks[i:i + concurrency * 2]):
+                whole.update(body)
+                f.write(body)
+
+    if whole.hexdigest() != manifest['sha256']:
+        raise Exception(f"reassembled image does not match the sha256 in {manifest_key}")
+    print("Reassembled " + manifest_key + " into " + output)
@@ -0,0 +1,131 @@
+"""
+S3 Streaming Module
+
+This module uploads a squashfs image to S3 while mksquashfs is still writing
+it. mksquashfs needs a seekable output and writes the superblock at the start
+of the file when it finishes, so the image is written to a local file as usual,
+but every part behind the write position is uploaded as soon as it is complete
+and then punched out of the local file. The first part, which holds the
+superblock, is uploaded last.
+
+This only works if mksquashfs never goes back to a part behind its write
+position, so it has to run with -no-duplicates: with duplicate detection, it
+reads earlier blocks back to compare them and rewinds over a file it found to
+be a duplicate.
+"""
+
+import ctypes
+import logging
+import os
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+_libc = ctypes.CDLL(None, use_errno=True)
+_libc.fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong]
+
+def _punch_hole(fd, offset, length):
+    """Frees the disk space of an uploaded part"""
+    if _libc.fallocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, offset, length) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, "cannot punch holes in the squashfs image, streaming needs a filesystem "
+                             "that supports it: " + os.strerror(errno))
+
+class StreamingUpload:
+    def __init__(self, client, bucket, key, part_size, max_parts):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        # Bounds the number of parts held in memory at once
+        self.slots = threading.Semaphore(max_parts)
+        self.pool = ThreadPoolExecutor(max_parts)
+        self.futures = []
+        self.parts = {}
+        self.logger = logging.getLogger(__name__)
+
+    def _upload_part(self, fd, number, offset, length, punch):
+        try:
+            data = os.pread(fd, length, offset)
+            res = self.client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                          PartNumber=number, Body=data)
+            self.parts[number] = res['ETag']
+            if punch:
+                _punch_hole(fd, offset, length)
+        finally:
+            self.slots.release()
+
+    def _submit(self, fd, number, offset, length, punch=True):
+        # Stop early if an earlier part failed
+        for f in self.futures:
+            if f.done() and f.exception():
+                raise f.exception()
+        self.slots.acquire()
+        self.futures.append(self.pool.submit(self._upload_part, fd, number, offset, length, punch))
+
+    def run(self, args, fname, poll=0.5):
+        """
+        Runs the command in args, which writes fname, and uploads fname while it grows.
+        The command must only ever append to fname.
+
+        Returns:
+            int: return code of the command
+        """
+        print("Streaming " + fname + " as " + self.key + " to " + self.bucket)
+        open(fname, 'wb').close()
+        fd = os.open(fname, os.O_RDWR)
+        try:
+            # Fail before uploading anything if the disk use cannot be bounded
+            _punch_hole(fd, 0, self.part_size)
+            self.upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=self.key)['UploadId']
+        except BaseException:
+            os.close(fd)
+            raise
+        process = None
+        try:
+            process = subprocess.Popen(args, stdout=subprocess.DEVNULL)
+            # Part 1 is left until the end. A part is only uploaded once the
+            # file has grown a full part beyond it, so writes that are still
+            # in flight do not end up in an uploaded part.
+            number = 2
+            while True:
+                done = process.poll() is not None
+                size = os.fstat(fd).st_size
+                while (number + 1) * self.part_size <= size:
+                    self._submit(fd, number, (number - 1) * self.part_size, self.part_size)
+                    number += 1
+                if done:
+                    break
+                time.sleep(poll)
+
+            if process.returncode != 0:
+                raise subprocess.CalledProcessError(process.returncode, args)
+
+            # Remaining tail parts, then the first part with the final superblock
+            size = os.fstat(fd).st_size
+            offset = (number - 1) * self.part_size
+            while offset < size:
+                self._submit(fd, number, offset, min(self.part_size, size - offset))
+                number += 1
+                offset += self.part_size
+            self._submit(fd, 1, 0, min(self.part_size, size), punch=False)
+            for f in self.futures:
+                f.result()
+
+            parts = [{'PartNumber': n, 'ETag': self.parts[n]} for n in sorted(self.parts)]
+            self.client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                                  MultipartUpload={'Parts': parts})
+            self.logger.info(f"streamed {size} bytes to {self.bucket}/{self.key} in {len(parts)} parts")
+            return process.returncode
+        except BaseException:
+            if process and process.poll() is None:
+                process.kill()
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+            raise
+        finally:
+            self.pool.shutdown(wait=True)
+            os.close(fd)
@@ -0,0 +1,228 @@
+"""
+Size Report Module
+
+This module finds out where the space in a mounted rootfs goes. The rootfs is
+scanned by several threads at once, a file with several hardlinks is counted
+once, and the usage is attributed to the RPM packages that own the files and
+to the top directories. The resulting summary is small enough to keep for
+every build, and the summaries of two builds can be compared to see what made
+an image grow.
+"""
+
+import datetime
+import glob
+import json
+import logging
+import os
+import stat
+from concurrent.futures import ThreadPoolExecutor
+# written modules
+from copyfiles import RootfsCopier
+from tracing import traced
+from utils import cmd
+
+SUMMARY_VERSION = 1
+# Directories are summed up to this depth, like /usr/lib
+DIR_DEPTH = 2
+UNPACKAGED = '(unpackaged)'
+
+def _walk(top, dev):
+    """Returns (path, size, inode) for every file below top, inode only for hardlinked files"""
+    found = []
+    stack = [top]
+    while stack:
+        try:
+            it = os.scandir(stack.pop())
+        except OSError:
+            continue
+        with it:
+            for e in it:
+                try:
+                    st = e.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                if stat.S_ISDIR(st.st_mode):
+                    # Stay on the filesystem of the rootfs
+                    if st.st_dev == dev:
+                        stack.append(e.path)
+                else:
+                    found.append((e.path, st.st_size, st.st_ino if st.st_nlink > 1 else None))
+    return found
+
+def scan(root, workers=8):
+    """
+    Scans root, every directory DIR_DEPTH levels down in its own task
+
+    Returns:
+        dict: size of every file by its path inside root. Of the paths of a
+              hardlinked file, only the first one gets its size.
+    """
+    root = os.path.realpath(root)
+    dev = os.lstat(root).st_dev
+    found = []
+    level = [root]
+    for _ in range(DIR_DEPTH):
+        subdirs = []
+        for d in level:
+            try:
+                entries = list(os.scandir(d))
+            except OSError:
+                continue
+            for e in entries:
+                try:
+                    st = e.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                if stat.S_ISDIR(st.st_mode):
+                    if st.st_dev == dev:
+                        subdirs.append(e.path)
+                else:
+                    found.append((e.path, st.st_size, st.st_ino if st.st_nlink > 1 else None))
+        level = subdirs
+
+    with ThreadPoolExecutor(max(workers, 1)) as pool:
+        for files in pool.map(lambda d: _walk(d, dev), level):
+            found.extend(files)
+
+    sizes = {}
+    seen = set()
+    for path, size, ino in sorted(found):
+        if ino is not None:
+            if ino in seen:
+                size = 0
+            seen.add(ino)
+        sizes[path[len(root):]] = size
+    return sizes
+
+def package_files(root):
+    """
+    Lists the files of the packages installed in root with rpm
+
+    Returns:
+        list: (package name, path) pairs
+    """
+    out = []
+    rc = cmd(["rpm", "--root", root, "-qa", "--qf", "[%{=NAME}\\t%{FILENAMES}\\n]"],
+             stdout_handler=out.append, stderr_handler=logging.debug, check=False)
+    if rc != 0:
+        logging.warn(f"SIZE: could not list the packages in {root}, counting every file as unpackaged")
+        return []
+    return [tuple(line.split('\t', 1)) for line in out if '\t' in line]
+
+@traced('size_report.summarize')
+def summarize(root, name, tag, workers=8):
+    """
+    Attributes the disk usage of root to packages and top directories
+
+    Returns:
+        dict: the summary
+    """
+    sizes = scan(root, workers)
+
+    # Packages list paths as installed, which may go through symlinks such as /lib -> usr/lib
+    copier = RootfsCopier(root)
+    real_root = copier.root
+    resolved_dirs = {}
+    owners = {}
+    for pkg, path in package_files(root):
+        if path not in sizes:
+            d, base = os.path.split(path)
+            if d not in resolved_dirs:
+                resolved_dirs[d] = copier.resolve(d)[len(real_root):]
+            path = resolved_dirs[d].rstrip('/') + '/' + base
+        # Files shared by packages count for the first one
+        owners.setdefault(path, pkg)
+
+    packages = {}
+    dirs = {}
+    for path, size in sizes.items():
+        pkg = owners.get(path, UNPACKAGED)
+        packages[pkg] = packages.get(pkg, 0) + size
+        parts = path.split('/')[1:-1]
+        for depth in range(1, min(DIR_DEPTH, len(parts)) + 1):
+            d = '/' + '/'.join(parts[:depth])
+            dirs[d] = dirs.get(d, 0) + size
+
+    return {
+        'version': SUMMARY_VERSION,
+        'name': name,
+        'tag': tag,
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'total': sum(sizes.values()),
+        'files': len(sizes),
+        'packages': packages,
+        'dirs': dirs,
+    }
+
+def save(summary, report_dir):
+    """
+    Stores summary under report_dir, next to the earlier builds of the same name
+
+    Returns:
+        str: path of the stored summary
+    """
+    d = os.path.join(os.path.expanduser(report_dir), summary['name'])
+    os.makedirs(d, exist_ok=True)
+    path = os.path.join(d, summary['date'].replace(':', '') + '.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(summary, f, separators=(',', ':'), sort_keys=True)
+    os.replace(path + '.tmp', path)
+    return path
+
+def load(path):
+    with open(path, 'r') as f:
+        summary = json.load(f)
+    if summary.get('version') != SUMMARY_VERSION:
+        raise ValueError(f"{path} is not a version {SUMMARY_VERSION} size summary")
+    return summary
+
+def load_previous(report_dir, name):
+    """Returns the newest stored summary for name, or None"""
+    paths = sorted(glob.glob(os.path.join(os.path.expanduser(report_dir), glob.escape(name), '*.json')))
+    if not paths:
+        return None
+    return load(paths[-1])
+
+def _mib(size):
+    return f"{size / 1024**2:.1f} MiB"
+
+def _top(sizes, limit):
+    return sorted(sizes.items(), key=lambda i: -i[1])[:limit]
+
+def format_summary(summary, limit=15):
+    """Returns the lines of a report of the largest packages and directories"""
+    lines = [f"{summary['name']}:{summary['tag']}: {_mib(summary['total'])} in {summary['files']} files"]
+    lines.append("  largest packages:")
+    lines.extend(f"    {_mib(size):>12}  {pkg}" for pkg, size in _top(summary['packages'], limit))
+    lines.append("  largest directories:")
+    lines.extend(f"    {_mib(size):>12}  {d}" for d, size in _top(summary['dirs'], limit))
+    return lines
+
+def _changes(old, new, limit):
+    changes = []
+    for key in set(old) | set(new):
+        delta = new.get(key, 0) - old.get(key, 0)
+        if delta == 0:
+            continue
+        if key not in old:
+            note = " (new)"
+        elif key not in new:
+            note = " (gone)"
+        else:
+            note = ""
+        changes.append((delta, key, note))
+    changes.sort(key=lambda c: -abs(c[0]))
+    return [f"    {('+' if delta > 0 else '-') + _mib(abs(delta)):>12}  {key}{note}"
+            for delta, key, note in changes[:limit]]
+
+def diff(old, new, limit=15):
+    """Returns the lines of a report of what changed in size between two summaries"""
+    delta = new['total'] - old['total']
+    lines = [f"{new['name']}:{new['tag']} {'grew' if delta >= 0 else 'shrank'} by {_mib(abs(delta))} "
+             f"since {old['name']}:{old['tag']} of {old['date']} "
+             f"({_mib(old['total'])} -> {_mib(new['total'])}, {old['files']} -> {new['files']} files)"]
+    lines.append("  packages:")
+    lines.extend(_changes(old['packages'], new['packages'], limit) or ["    no changes"])
+    lines.append("  directories:")
+    lines.extend(_changes(old['dirs'], new['dirs'], limit) or ["    no changes"])
+    return lines
@@ -0,0 +1,184 @@
+"""
+Slim Module
+
+This module provides a class, Slimmer, that removes files a booted image does
+not need from a mounted rootfs before it is published: documentation, package
+manager caches, log files, locales outside of an allowlist and any paths given
+as globs. Every node downloads the whole image at boot, so the bytes each rule
+reclaimed are reported.
+
+Paths are only removed inside the rootfs. Globs that go through a symlink
+pointing outside of it are skipped, and mount points (such as the ones the
+chroot execution backend adds) are never descended into.
+"""
+
+import glob
+import logging
+import os
+import stat
+# written modules
+from tracing import traced
+
+DOC_PATHS = ['/usr/share/doc/*', '/usr/share/man/*', '/usr/share/info/*',
+             '/usr/share/gtk-doc/*', '/usr/share/help/*']
+PKG_CACHE_PATHS = ['/var/cache/dnf/*', '/var/cache/yum/*', '/var/cache/zypp/*']
+LOG_DIR = '/var/log'
+LOCALE_DIRS = ['/usr/share/locale', '/usr/lib/locale']
+# Locales that are always kept
+BUILTIN_LOCALES = ('C', 'POSIX')
+
+class Slimmer:
+    def __init__(self, root, options):
+        self.root = os.path.realpath(root)
+        self.options = options
+        self.logger = logging.getLogger(__name__)
+        # Hardlinked files only count once
+        self._seen = set()
+        self._mounts = self._mount_points()
+
+    def _mount_points(self):
+        """Returns the mount points below the rootfs, including bind mounts from the same filesystem"""
+        mounts = set()
+        try:
+            with open('/proc/self/mountinfo', 'r') as f:
+                for line in f:
+                    # The mount point is the fifth field, with octal escapes
+                    path = line.split()[4].encode().decode('unicode_escape')
+                    if path.startswith(self.root + os.sep):
+                        mounts.add(path)
+        except OSError:
+            pass
+        return mounts
+
+    def rules(self):
+        """Returns the rules the options ask for, as (name, function) pairs"""
+        rules = []
+        if self.options.get('docs'):
+            rules.append(('docs', lambda: self._remove_globs(DOC_PATHS)))
+        if self.options.get('pkg_cache'):
+            rules.append(('pkg_cache', lambda: self._remove_globs(PKG_CACHE_PATHS)))
+        if self.options.get('logs'):
+            rules.append(('logs', self._remove_logs))
+        if 'locales' in self.options:
+            rules.append(('locales', lambda: self._remove_locales(self.options['locales'])))
+        for pattern in self.options.get('paths', []):
+            rules.append((pattern, lambda pattern=pattern: self._remove_globs([pattern])))
+        return rules
+
+    @traced('slim.run')
+    def run(self):
+        """
+        Applies every rule and logs what each of them reclaimed
+
+        Returns:
+            list: (rule, files, bytes) for every rule
+        """
+        report = []
+        for name, rule in self.rules():
+            files, size = rule()
+            report.append((name, files, size))
+            self.logger.info(f"SLIM: {name}: removed {files} files, {size / 1024**2:.1f} MiB")
+        total_files = sum(r[1] for r in report)
+        total_size = sum(r[2] for r in report)
+        self.logger.info(f"SLIM: reclaimed {total_size / 1024**2:.1f} MiB in {total_files} files")
+        return report
+
+    def _inside(self, path):
+        """
+        Whether path (not following a link at path itself) is inside the
+        rootfs, and not below something mounted into it
+        """
+        parent = os.path.realpath(os.path.dirname(path))
+        if parent != self.root and not parent.startswith(self.root + os.sep):
+            return False
+        return not any(parent == m or parent.startswith(m + os.sep) for m in self._mounts)
+
+    def _glob(self, pattern):
+        matches = []
+        for m in sorted(glob.glob(os.path.join(self.root, pattern.lstrip('/')))):
+            if os.path.normpath(m) == self.root:
+                continue
+            if not self._inside(m):
+                self.logger.warn(f"SLIM: skipping {m}, it is outside of the rootfs or below a mount point")
+                continue
+            matches.append(m)
+        return matches
+
+    def _count(self, st):
+        if st.st_nlink > 1:
+            if (st.st_dev, st.st_ino) in self._seen:
+                return 0
+            self._seen.add((st.st_dev, st.st_ino))
+        return st.st_size
+
+    def _remove(self, path, keep_dirs=False):
+        """
+        Removes path and everything below it, except mount points
+
+        Returns:
+            tuple: number of files and bytes removed
+        """
+        st = os.lstat(path)
+        if not stat.S_ISDIR(st.st_mode):
+            size = self._count(st)
+            os.unlink(path)
+            return 1, size
+        if os.path.normpath(path) in self._mounts or os.path.ismount(path):
+            self.logger.warn(f"SLIM: skipping {path}, it is a mount point")
+            return 0, 0
+        files = 0
+        size = 0
+        with os.scandir(path) as entries:
+            for entry in list(entries):
+                f, s = self._remove(entry.path, keep_dirs)
+                files += f
+                size += s
+        if not keep_dirs:
+            try:
+                os.rmdir(path)
+            except OSError:
+                # Something below it was kept
+                pass
+        return files, size
+
+    def _remove_globs(self, patterns):
+        files = 0
+        size = 0
+        for pattern in patterns:
+            for path in self._glob(pattern):
+                f, s = self._remove(path)
+                files += f
+                size += s
+        return files, size
+
+    def _remove_logs(self):
+        """Removes the log files, keeping the directories services log into"""
+        path = os.path.join(self.root, LOG_DIR.lstrip('/'))
+        if not os.path.isdir(path) or not self._inside(path):
+            return 0, 0
+        return self._remove(path, keep_dirs=True)
+
+    def _remove_locales(self, keep):
+        """Removes the locale directories whose language is not in keep"""
+        def kept(name):
+            for k in list(keep) + list(BUILTIN_LOCALES):
+                # 'en' keeps en_US and en_GB, 'en_US' keeps en_US.utf8
+                if name == k or any(name.startswith(k + sep) for sep in '_.@'):
+                    return True
+            return False
+
+        files = 0
+        size = 0
+        for d in LOCALE_DIRS:
+            path = os.path.join(self.root, d.lstrip('/'))
+            if not os.path.isdir(path) or not self._inside(path):
+                continue
+            for name in sorted(os.listdir(path)):
+                full = os.path.join(path, name)
+                # Files like locale-archive and locale.alias are kept
+                if os.path.islink(full) or not os.path.isdir(full) or kept(name):
+                    continue
+                f, s = self._remove(full)
+                files += f
+                size += s
+        return files, size
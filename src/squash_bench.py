@@ -0,0 +1,91 @@
+"""
+SquashFS Benchmark Module
+
+This module squashes a rootfs with a matrix of squashfs settings and measures
+wall time, CPU time, image size and decompression throughput for each, to
+help pick the squashfs_* options for an image.
+"""
+
+import itertools
+import logging
+import os
+import resource
+import shutil
+import time
+# written modules
+from squashfs import squash_args
+from utils import cmd
+
+def _tree_size(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            p = os.path.join(root, f)
+            if not os.path.islink(p):
+                total += os.lstat(p).st_size
+    return total
+
+def _children_cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+def _timed(args):
+    wall = time.monotonic()
+    cpu = _children_cpu()
+    cmd(args, stdout_handler=logging.debug)
+    return time.monotonic() - wall, _children_cpu() - cpu
+
+def run_benchmark(rootfs, workdir, compressors, levels, block_sizes, processors, exclude=[], decompress=True):
+    """
+    Squashes rootfs once for every combination of the given settings
+
+    Returns:
+        list: one dict of settings and measurements per combination
+    """
+    os.makedirs(workdir, exist_ok=True)
+    image = os.path.join(workdir, "bench.sqfs")
+    extract = os.path.join(workdir, "extract")
+    rootfs_size = _tree_size(rootfs)
+    logging.info(f"rootfs {rootfs} holds {rootfs_size} bytes")
+
+    results = []
+    seen = []
+    for compressor, level, block_size, procs in itertools.product(compressors, levels, block_sizes, processors):
+        opts = {'compressor': compressor, 'level': level, 'block_size': block_size,
+                'processors': procs, 'exclude': exclude}
+        args = squash_args(rootfs, image, opts)
+        # Compressors without levels give the same command for every level
+        if args in seen:
+            continue
+        seen.append(args)
+
+        logging.info("benchmarking " + " ".join(args))
+        wall, cpu = _timed(args)
+        result = dict(opts)
+        result.update({
+            'wall_time': wall,
+            'cpu_time': cpu,
+            'size': os.path.getsize(image),
+            'ratio': os.path.getsize(image) / rootfs_size if rootfs_size else 0,
+        })
+
+        if decompress:
+            shutil.rmtree(extract, ignore_errors=True)
+            unsquash_wall, unsquash_cpu = _timed(["unsquashfs", "-no-progress", "-d", extract, image])
+            result['decompress_time'] = unsquash_wall
+            result['decompress_throughput'] = rootfs_size / unsquash_wall if unsquash_wall else 0
+            shutil.rmtree(extract, ignore_errors=True)
+
+        os.remove(image)
+        results.append(result)
+    return results
+
+def print_results(results):
+    print("SQUASHFS BENCHMARK".center(100, '-'))
+    print(f"{'compressor':<10} {'level':>5} {'block':>6} {'procs':>5} {'wall s':>9} {'cpu s':>9} {'size MiB':>10} {'ratio':>6} {'unsquash MiB/s':>15}")
+    for r in results:
+        throughput = r.get('decompress_throughput')
+        print(f"{str(r['compressor'] or 'default'):<10} {str(r['level'] if r['level'] is not None else '-'):>5} "
+              f"{str(r['block_size'] or '-'):>6} {str(r['processors'] or '-'):>5} "
+              f"{r['wall_time']:>9.2f} {r['cpu_time']:>9.2f} {r['size'] / 1024**2:>10.1f} {r['ratio']:>6.3f} "
+              f"{(throughput / 1024**2 if throughput else 0):>15.1f}")
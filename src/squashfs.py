@@ -0,0 +1,71 @@
+"""
+SquashFS Module
+
+This module builds the mksquashfs command line from the squashfs_* options
+and squashes a rootfs with it.
+"""
+
+import logging
+# written modules
+from utils import cmd
+from tracing import traced
+
+COMPRESSORS = ['gzip', 'xz', 'zstd', 'lz4', 'lzo', 'lzma']
+
+def squash_options(args):
+    """Collects the squashfs_* options from the processed arguments"""
+    return {
+        'compressor': args.get('squashfs_compressor'),
+        'level': args.get('squashfs_level'),
+        'block_size': args.get('squashfs_block_size'),
+        'processors': args.get('squashfs_processors'),
+        'exclude': args.get('squashfs_exclude', []),
+        'no_duplicates': False,
+    }
+
+def squash_args(mname, dest, squash_opts=None):
+    """
+    Generates the mksquashfs command for squashing mname into dest
+
+    Returns:
+        list: mksquashfs command
+    """
+    squash_opts = squash_opts or {}
+    args = ["mksquashfs", mname, dest, "-noappend"]
+
+    compressor = squash_opts.get('compressor')
+    level = squash_opts.get('level')
+    if compressor:
+        if compressor not in COMPRESSORS:
+            raise ValueError(f"unsupported squashfs compressor '{compressor}', must be one of {', '.join(COMPRESSORS)}")
+        args.extend(["-comp", compressor])
+    if level is not None and level != '':
+        if compressor in (None, 'gzip', 'zstd', 'lzo'):
+            args.extend(["-Xcompression-level", str(level)])
+        elif compressor == 'lz4':
+            # lz4 only has a normal and a high compression mode
+            if int(level) > 0:
+                args.append("-Xhc")
+        else:
+            logging.warn(f"squashfs compressor {compressor} has no compression level, ignoring level {level}")
+
+    if squash_opts.get('block_size'):
+        args.extend(["-b", str(squash_opts['block_size'])])
+    if squash_opts.get('processors'):
+        args.extend(["-processors", str(squash_opts['processors'])])
+    if squash_opts.get('no_duplicates'):
+        args.append("-no-duplicates")
+
+    # -e has to be the last option
+    if squash_opts.get('exclude'):
+        args.append("-wildcards")
+        args.append("-e")
+        args.extend(squash_opts['exclude'])
+    return args
+
+@traced('squashfs.squash_image')
+def squash_image(mname, dest, squash_opts=None):
+    print("squashing container image")
+    args = squash_args(mname, dest, squash_opts)
+    logging.info("running " + " ".join(args))
+    cmd(args, stdout_handler=logging.debug)
@@ -0,0 +1,112 @@
+"""
+Build Steps Module
+
+This module provides a class, StepGraph, that runs the steps of a build as a
+small dependency graph. Every step starts as soon as the steps it depends on
+have finished, with at most max_workers steps running at the same time. The
+steps themselves are ordinary blocking functions, run in worker threads by an
+asyncio event loop.
+"""
+
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+# written modules
+from utils import CommandEngine, using_engine
+
+class StepError(Exception):
+    """Raised by StepGraph.run() with the first step that failed"""
+    def __init__(self, step, error):
+        super().__init__(f"{step.description}: {error}")
+        self.step = step
+        self.error = error
+
+class Step:
+    def __init__(self, name, func, after, description):
+        self.name = name
+        self.func = func
+        self.after = after
+        self.description = description
+        self.status = 'pending'
+
+class StepGraph:
+    def __init__(self, max_workers=1):
+        self.max_workers = max(1, int(max_workers or 1))
+        self.steps = {}
+        self.logger = logging.getLogger(__name__)
+
+    def __contains__(self, name):
+        return name in self.steps
+
+    def add(self, name, func, after=(), description=None):
+        """
+        Adds the step name, which runs func() once all steps in after are done.
+        Steps can only depend on steps that were added before them, so the
+        graph cannot have cycles.
+        """
+        if name in self.steps:
+            raise ValueError(f"step '{name}' was already added")
+        for dep in after:
+            if dep not in self.steps:
+                raise ValueError(f"step '{name}' depends on unknown step '{dep}'")
+        self.steps[name] = Step(name, func, list(after), description or name)
+
+    def run(self):
+        """
+        Runs all steps. After the first failure no more steps are started and
+        the commands of the steps that are still running are killed.
+
+        Raises:
+            StepError: for the first step that failed
+        """
+        # The commands of the steps run with an engine of their own, so that
+        # cancelling them leaves the commands of other builds alone
+        engine = CommandEngine()
+        pool = ThreadPoolExecutor(self.max_workers, thread_name_prefix='step')
+        try:
+            failed = asyncio.run(self._run(pool, engine))
+        except KeyboardInterrupt:
+            engine.cancel()
+            raise
+        finally:
+            pool.shutdown(wait=True)
+        if failed:
+            raise StepError(*failed[0])
+
+    @staticmethod
+    def _call(func, engine):
+        with using_engine(engine):
+            func()
+
+    async def _run(self, pool, engine):
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(self.max_workers)
+        tasks = {}
+        failed = []
+
+        async def run_step(step):
+            if step.after:
+                await asyncio.wait([tasks[dep] for dep in step.after])
+            async with slots:
+                if failed:
+                    step.status = 'skipped'
+                    return
+                step.status = 'running'
+                self.logger.debug(f"STEPS: starting {step.name}")
+                try:
+                    await loop.run_in_executor(pool, self._call, step.func, engine)
+                except Exception as e:
+                    step.status = 'failed'
+                    if not failed:
+                        # Nothing will be built anyway, so stop the other steps early
+                        engine.cancel()
+                    failed.append((step, e))
+                else:
+                    step.status = 'done'
+                    self.logger.debug(f"STEPS: finished {step.name}")
+
+        # Steps were added after their dependencies, so those tasks already exist
+        for step in self.steps.values():
+            tasks[step.name] = asyncio.ensure_future(run_step(step))
+        await asyncio.gather(*tasks.values())
+        return failed
@@ -0,0 +1,147 @@
+"""
+Tracing Module
+
+This module records nested timing spans for the phases of a build and for
+every external command, and writes them out as a trace file (in the Chrome
+trace event format, which Perfetto and chrome://tracing can show) and as a
+Prometheus textfile-collector metrics file.
+"""
+
+import contextlib
+import functools
+import itertools
+import json
+import os
+import threading
+import time
+
+_lock = threading.Lock()
+_ids = itertools.count(1)
+_spans = []
+_stacks = {}
+_main_thread = threading.main_thread().ident
+# Offset to turn time.monotonic() into wall clock time
+_epoch = time.time() - time.monotonic()
+
+def _stack():
+    return _stacks.setdefault(threading.get_ident(), [])
+
+@contextlib.contextmanager
+def span(name, **attrs):
+    """Records the time spent in the with block as a span nested in the current span"""
+    stack = _stack()
+    if stack:
+        parent = stack[-1]['id']
+    else:
+        # Spans in worker threads belong to whatever the main thread is doing
+        main = _stacks.get(_main_thread)
+        parent = main[-1]['id'] if main else None
+    sp = {
+        'id': next(_ids),
+        'parent': parent,
+        'name': name,
+        'start': time.monotonic(),
+        'tid': threading.get_ident(),
+        'attrs': attrs,
+        'status': 'ok',
+    }
+    stack.append(sp)
+    try:
+        yield sp
+    except BaseException:
+        sp['status'] = 'error'
+        raise
+    finally:
+        sp['duration'] = time.monotonic() - sp['start']
+        stack.pop()
+        with _lock:
+            _spans.append(sp)
+
+def traced(name):
+    """Decorator that records every call of the function as a span"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def spans():
+    with _lock:
+        return sorted(_spans, key=lambda s: s['start'])
+
+def _atomic_write(path, data):
+    with open(path + ".tmp", 'w') as f:
+        f.write(data)
+    os.replace(path + ".tmp", path)
+
+def write_trace(path):
+    events = []
+    for sp in spans():
+        args = dict(sp['attrs'])
+        args.update({'id': sp['id'], 'parent': sp['parent'], 'status': sp['status']})
+        events.append({
+            'name': sp['name'],
+            'ph': 'X',
+            'ts': int((sp['start'] + _epoch) * 1e6),
+            'dur': int(sp['duration'] * 1e6),
+            'pid': os.getpid(),
+            'tid': sp['tid'],
+            'args': args,
+        })
+    _atomic_write(path, json.dumps({'traceEvents': events, 'displayTimeUnit': 'ms'}, default=str))
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(labels):
+    return ','.join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+
+def write_metrics(path, image, success):
+    """
+    Writes phase durations, external command totals and the build result in
+    the Prometheus text format, for the node exporter textfile collector.
+    """
+    phases = {}
+    commands = {}
+    total = 0.0
+    for sp in spans():
+        if sp['parent'] is None:
+            total += sp['duration']
+        if 'command' in sp['attrs']:
+            c = commands.setdefault(sp['attrs']['command'], [0, 0.0])
+            c[0] += 1
+            c[1] += sp['duration']
+        else:
+            phases[sp['name']] = phases.get(sp['name'], 0.0) + sp['duration']
+
+    lines = [
+        '# HELP image_build_duration_seconds Wall time of the whole build.',
+        '# TYPE image_build_duration_seconds gauge',
+        f'image_build_duration_seconds{{{_labels({"image": image})}}} {total:.6f}',
+        '# HELP image_build_success Whether the last build succeeded.',
+        '# TYPE image_build_success gauge',
+        f'image_build_success{{{_labels({"image": image})}}} {1 if success else 0}',
+        '# HELP image_build_last_run_timestamp_seconds When the last build finished.',
+        '# TYPE image_build_last_run_timestamp_seconds gauge',
+        f'image_build_last_run_timestamp_seconds{{{_labels({"image": image})}}} {time.time():.0f}',
+        '# HELP image_build_phase_duration_seconds Time spent in each build phase.',
+        '# TYPE image_build_phase_duration_seconds gauge',
+    ]
+    for name, duration in sorted(phases.items()):
+        lines.append(f'image_build_phase_duration_seconds{{{_labels({"image": image, "phase": name})}}} {duration:.6f}')
+    lines += [
+        '# HELP image_build_command_duration_seconds Time spent in external commands.',
+        '# TYPE image_build_command_duration_seconds gauge',
+    ]
+    for name, (count, duration) in sorted(commands.items()):
+        lines.append(f'image_build_command_duration_seconds{{{_labels({"image": image, "command": name})}}} {duration:.6f}')
+    lines += [
+        '# HELP image_build_command_runs Number of times each external command ran.',
+        '# TYPE image_build_command_runs gauge',
+    ]
+    for name, (count, duration) in sorted(commands.items()):
+        lines.append(f'image_build_command_runs{{{_labels({"image": image, "command": name})}}} {count}')
+
+    _atomic_write(path, '\n'.join(lines) + '\n')
@@ -4,11 +4,14 @@ from ansible.module_utils.common.collections import ImmutableDict
 from ansible.inventory.manager import InventoryManager
 from ansible.parsing.dataloader import DataLoader
 from ansible.executor.playbook_executor import PlaybookExecutor
+from ansible.executor.task_queue_manager import TaskQueueManager
 from ansible.playbook import Playbook
+from ansible.playbook.play import Play
 from ansible.vars.manager import VariableManager
 from ansible.config.manager import ConfigManager
 from ansible.cli.config import ConfigCLI
 from ansible.parsing.yaml.objects import AnsibleVaultEncryptedUnicode
+from ansible import constants as C
 
 try:
     from ansible.plugins.loader import init_plugin_loader
@@ -19,12 +22,19 @@ except ImportError:
 
 import subprocess
 import logging
-from collections import deque
-from concurrent.futures import ThreadPoolExecutor
-from functools import partial
-from subprocess import PIPE, CalledProcessError, CompletedProcess, Popen
+import codecs
+import contextlib
+import locale
+import re
+import selectors
+import threading
+import time
+from subprocess import PIPE, CalledProcessError, CompletedProcess, Popen, TimeoutExpired
 import json
+import os
 import yaml
+# written modules
+from tracing import span
 
 def get_os(mdir):
     os_dict = {}
@@ -41,9 +51,172 @@ def get_os(mdir):
         os_version=os_dict['ID_LIKE'].rstrip().replace('"','')+'-'+os_dict['NAME'].rstrip().replace('"','')
     return os_version.lower()
 
-#####
-# Shamelessly stolen from https://stackoverflow.com/questions/18421757/live-output-from-subprocess-command/76634163#76634163
-# User: ddelange
+SIZE_SUFFIXES = {'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+
+def parse_size(size):
+    """Converts a size like '20G' or 1048576 into bytes"""
+    if not size:
+        return 0
+    size = str(size).strip().upper().rstrip('B')
+    if size[-1] in SIZE_SUFFIXES:
+        return int(float(size[:-1]) * SIZE_SUFFIXES[size[-1]])
+    return int(size)
+
+# Same line endings as universal newlines mode
+_NEWLINES = re.compile(r'\r\n|\r|\n')
+
+class _LineSplitter:
+    """Splits the chunks read from a pipe into lines and passes each line to handler"""
+    def __init__(self, handler, text):
+        self.handler = handler
+        self.text = text
+        if text:
+            self.decoder = codecs.getincrementaldecoder(locale.getpreferredencoding(False))(errors='replace')
+            self.buf = ''
+        else:
+            self.buf = b''
+
+    def feed(self, data):
+        if self.text:
+            buf = self.buf + self.decoder.decode(data)
+            # A trailing '\r' may be the first half of a '\r\n'
+            cut = len(buf) - 1 if buf.endswith('\r') else len(buf)
+            *lines, rest = _NEWLINES.split(buf[:cut])
+            self.buf = rest + buf[cut:]
+        else:
+            *lines, self.buf = (self.buf + data).split(b'\n')
+        for line in lines:
+            self.handler(line)
+
+    def close(self):
+        if self.text:
+            self.buf = (self.buf + self.decoder.decode(b'', final=True)).rstrip('\r')
+        if self.buf:
+            self.handler(self.buf)
+
+class CommandEngine:
+    """
+    Runs subprocesses and multiplexes their stdout and stderr with a selector
+    in the calling thread, reading large chunks at a time, instead of starting
+    reader threads for every command. Running commands can be cancelled from
+    any thread.
+    """
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._running = set()
+        self._cancelled = False
+
+    def run(self, args, stdout_handler, stderr_handler, text=True, stdout=PIPE, stderr=PIPE, timeout=None, **kwargs):
+        """
+        Runs args, passing every line of output to the handlers
+
+        Returns:
+            int: return code of the command
+        """
+        process = Popen(args, stdout=stdout, stderr=stderr, **kwargs)
+        with self._lock:
+            self._running.add(process)
+        try:
+            if self._cancelled:
+                process.kill()
+            deadline = time.monotonic() + timeout if timeout else None
+            self._pump(process, stdout_handler, stderr_handler, text, deadline, timeout)
+            remaining = deadline - time.monotonic() if deadline else None
+            try:
+                process.wait(timeout=remaining)
+            except TimeoutExpired:
+                raise TimeoutExpired(args, timeout)
+        except BaseException:
+            process.kill()
+            process.wait()
+            raise
+        finally:
+            with self._lock:
+                self._running.discard(process)
+            for pipe in (process.stdout, process.stderr):
+                if pipe:
+                    pipe.close()
+        return process.returncode
+
+    def _pump(self, process, stdout_handler, stderr_handler, text, deadline, timeout):
+        with selectors.DefaultSelector() as sel:
+            for pipe, handler in ((process.stdout, stdout_handler), (process.stderr, stderr_handler)):
+                if pipe is not None:
+                    sel.register(pipe, selectors.EVENT_READ, _LineSplitter(handler, text))
+            while sel.get_map():
+                remaining = None
+                if deadline:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise TimeoutExpired(process.args, timeout)
+                for key, _ in sel.select(remaining):
+                    data = os.read(key.fd, self.CHUNK_SIZE)
+                    if data:
+                        key.data.feed(data)
+                    else:
+                        sel.unregister(key.fileobj)
+                        key.data.close()
+
+    def cancel(self):
+        """Kills every running command and every command started afterwards"""
+        with self._lock:
+            self._cancelled = True
+            for process in self._running:
+                process.kill()
+
+    def reset(self):
+        """Allows commands to run again after cancel()"""
+        with self._lock:
+            self._cancelled = False
+
+# Used by cmd() unless the calling thread runs with an engine of its own
+engine = CommandEngine()
+_local = threading.local()
+
+def current_engine():
+    """Returns the engine cmd() runs commands of the calling thread with"""
+    return getattr(_local, 'engine', None) or engine
+
+@contextlib.contextmanager
+def using_engine(e):
+    """Runs the cmd() calls of the calling thread with e, so they can be cancelled together"""
+    previous = getattr(_local, 'engine', None)
+    _local.engine = e
+    try:
+        yield
+    finally:
+        _local.engine = previous
+
+# Options whose values are not written to trace files
+SECRET_OPTS = ('--creds', '--authfile', '--cert-dir', '--password', '--decryption-key',
+               '--encryption-key', '--sign-by', '--secret')
+# user:password@ in URLs, like proxies
+_URL_USERINFO = re.compile(r'(://)[^/@\s]+@')
+
+def redact(args):
+    """Returns the command line args as one string, with credentials replaced by ***"""
+    redacted = []
+    hide_next = False
+    for a in args:
+        a = str(a)
+        if hide_next:
+            redacted.append('***')
+            hide_next = False
+            continue
+        opt = a.split('=', 1)[0].split(' ', 1)[0]
+        if opt in SECRET_OPTS:
+            if a == opt:
+                hide_next = True
+                redacted.append(a)
+            else:
+                # --creds=user:pass, or "--creds user:pass" as one argument
+                redacted.append(opt + a[len(opt)] + '***')
+            continue
+        redacted.append(_URL_USERINFO.sub(r'\1***@', a))
+    return " ".join(redacted)
+
 def cmd(
     args,
     *,
@@ -53,21 +226,23 @@ def cmd(
     text=True,
     stdout=PIPE,
     stderr=PIPE,
+    timeout=None,
     **kwargs,
 ):
-    with Popen(args, text=text, stdout=stdout, stderr=stderr, **kwargs) as process:
-        with ThreadPoolExecutor(2) as pool:  # two threads to handle the streams
-            exhaust = partial(pool.submit, partial(deque, maxlen=0))
-            exhaust(stdout_handler(line[:-1]) for line in process.stdout)
-            exhaust(stderr_handler(line[:-1]) for line in process.stderr)
-    retcode = process.poll()
+    command = os.path.basename(args[0])
+    if command == "buildah" and len(args) > 1:
+        command += " " + args[1]
+    with span("cmd " + command, command=command, args=redact(args)) as sp:
+        retcode = current_engine().run(args, stdout_handler, stderr_handler, text=text, stdout=stdout, stderr=stderr,
+                                       timeout=timeout, **kwargs)
+        sp['attrs']['rc'] = retcode
     if check and retcode:
         if retcode != 107:
-            raise CalledProcessError(retcode, process.args)
-    CompletedProcess(process.args, retcode)
+            raise CalledProcessError(retcode, args)
+    CompletedProcess(args, retcode)
     return retcode
-   
-def run_playbook(cnames, ansible_inv, ansible_verbosity):
+
+def run_playbook(cnames, ansible_inv, ansible_verbosity, fact_cache=None):
 
     if plugin_loader_available:
         init_plugin_loader()
@@ -79,12 +254,26 @@ def run_playbook(cnames, ansible_inv, ansible_verbosity):
         for g in cdata['ansible_groups']:
             inventory.add_group(g)
             inventory.add_host(host=c, group=g)
-        inventory._inventory.set_variable(c, "ansible_connection", "buildah")
+        inventory._inventory.set_variable(c, "ansible_connection", cdata.get('ansible_connection', "buildah"))
+        if 'ansible_host' in cdata:
+            inventory._inventory.set_variable(c, "ansible_host", cdata['ansible_host'])
+        if cdata.get('ansible_pipelining'):
+            inventory._inventory.set_variable(c, "ansible_pipelining", True)
         if 'ansible_vars' in cdata:
             for k,v in cdata['ansible_vars'].items():
                 inventory._inventory.set_variable(c, k, v)
 
     variable_manager = VariableManager(loader=loader, inventory=inventory)
+    uncached = []
+    if fact_cache:
+        for c, cdata in cnames.items():
+            if not cdata.get('fact_cache_key'):
+                continue
+            facts = fact_cache.load(cdata['fact_cache_key'])
+            if facts:
+                variable_manager.set_host_facts(c, facts)
+            else:
+                uncached.append(c)
     for c in cnames:
         logging.info("Vars for host " + c + ":")
         ansible_vars = variable_manager.get_vars(host=inventory.get_host(c))
@@ -98,8 +287,10 @@ def run_playbook(cnames, ansible_inv, ansible_verbosity):
     subset = []
     for c, cdata in cnames.items():
         subset.append(c)
-        if cdata['ansible_pb'] not in pbs:
-            pbs.append(cdata['ansible_pb'])
+        playbooks = cdata['ansible_pb'] if isinstance(cdata['ansible_pb'], list) else [cdata['ansible_pb']]
+        for pb in playbooks:
+            if pb not in pbs:
+                pbs.append(pb)
 
     context.CLIARGS = ImmutableDict(
       tags={},
@@ -118,7 +309,37 @@ def run_playbook(cnames, ansible_inv, ansible_verbosity):
 
     CLI.get_host_list(inventory, context.CLIARGS['subset'])
 
-    pbex = PlaybookExecutor(playbooks=pbs, inventory=inventory, variable_manager=variable_manager, loader=loader, passwords={})
-    results = pbex.run()
+    gathering = C.DEFAULT_GATHERING
+    try:
+        if fact_cache:
+            _gather_facts(uncached, cnames, fact_cache, inventory, variable_manager, loader)
+            # Plays skip gathering facts for hosts that have facts by now
+            C.DEFAULT_GATHERING = 'smart'
+        pbex = PlaybookExecutor(playbooks=pbs, inventory=inventory, variable_manager=variable_manager, loader=loader, passwords={})
+        results = pbex.run()
+    finally:
+        C.DEFAULT_GATHERING = gathering
     if results != 0:
         raise Exception("Ansible playbook failed to run ")
+
+def _gather_facts(hosts, cnames, fact_cache, inventory, variable_manager, loader):
+    """
+    Gathers the facts of hosts in a play of its own, before any playbook runs,
+    and caches them, so the cache holds the facts of the image the containers
+    were created from rather than of what the playbooks made of them
+    """
+    if not hosts:
+        return
+    play = Play().load(dict(name="Gather facts", hosts=hosts, gather_facts=True, tasks=[]),
+                       variable_manager=variable_manager, loader=loader)
+    tqm = TaskQueueManager(inventory=inventory, variable_manager=variable_manager, loader=loader, passwords={})
+    try:
+        result = tqm.run(play)
+    finally:
+        tqm.cleanup()
+    if result != 0:
+        raise Exception("Ansible failed to gather facts")
+    for c in hosts:
+        facts = variable_manager.get_vars(host=inventory.get_host(c)).get('ansible_facts', {})
+        if facts.get('_ansible_facts_gathered'):
+            fact_cache.store(cnames[c]['fact_cache_key'], dict(facts))